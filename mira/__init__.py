@@ -1,19 +1,64 @@
-"""Package mira is a Flask back end for the Mira application."""
+"""Package mira is a Flask back end for the Mira application.
 
+create_app builds a new app each time it's called, so tests can build
+isolated ones. The app that tools like flask run use is created the first
+time something uses mira.app, so tools that only need parts of the package
+(like mira.codecs) don't pay for the rest.
+"""
+
+from importlib import import_module
+from time import perf_counter
 import os
 
 from flask import Flask
 
 from mira.config import get_config
 
-app = Flask(
-    "mira",
-    root_path=os.getcwd(),
-    template_folder="dist",
-    static_folder="dist/static",
-)
+# Modules with an init_app function that sets up part of the app, in order.
+SUBSYSTEMS = [
+    "mira.extensions",
+    "mira.metrics",
+    "mira.notifications",
+    "mira.passwords",
+    "mira.models",
+    "mira.thumbnails",
+    "mira.assets",
+    "mira.views",
+    "mira.maintenance",
+    "mira.queryplans",
+]
+
+# Seconds spent on each step of creating the last app.
+startup_seconds = {}
+
+
+def create_app(config=None):
+    """Create an app, with config overrides taking precedence.
+
+    Caches and worker pools are shared by the whole process, so they take
+    the settings of the last app created.
+    """
+    startup_seconds.clear()
+    start = perf_counter()
+    app = Flask(
+        "mira",
+        root_path=os.getcwd(),
+        template_folder="dist",
+        static_folder="dist/static",
+    )
+    env = (config or {}).get("ENV", app.env)
+    app.config.update(get_config(env, config))
+    startup_seconds["config"] = perf_counter() - start
+    for name in SUBSYSTEMS:
+        start = perf_counter()
+        import_module(name).init_app(app)
+        startup_seconds[name] = perf_counter() - start
+    return app
 
-app.config.update(get_config(app.env))
 
-import mira.extensions  # noqa
-import mira.views  # noqa
+def __getattr__(name):
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,142 @@
+"""This module serves the built Vue app from dist.
+
+Static files are compressed ahead of time by 'flask compress-assets', which
+run.sh runs after each build, and are sent in the best encoding the client
+accepts. Webpack puts a content hash in most file names, so clients can cache
+those forever.
+
+The index page is rendered once with placeholders for the per-request values
+(the CSP nonce, CSRF token, and username), which are then filled in for each
+request rather than rendering the template again.
+"""
+
+from threading import Lock
+import gzip
+import mimetypes
+import os
+import re
+
+import click
+from flask import (
+    current_app,
+    render_template,
+    request,
+    safe_join,
+    send_from_directory,
+)
+from flask.cli import with_appcontext
+from flask.json import htmlsafe_dumps as as_json
+
+
+# Encodings to precompress static files in, most preferred first.
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# Files smaller than this aren't worth compressing.
+MIN_COMPRESS_SIZE = 512
+# Files that are already compressed.
+COMPRESSED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".ico", ".woff2"}
+# Names like app.3f2a9c1e.js, which change whenever the content does.
+HASHED_NAME_REGEX = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Placeholders for the values that differ between requests.
+NONCE_PLACEHOLDER = "mira-csp-nonce-placeholder"
+CSRF_PLACEHOLDER = "mira-csrf-token-placeholder"
+USERNAME_PLACEHOLDER = "mira-username-placeholder"
+
+index_lock = Lock()
+# The template the index shell was rendered from, and the shell itself.
+index_cache = [None, None]
+
+
+def send_static(filename):
+    """Send a static file, precompressed if the client accepts it."""
+    folder = current_app.static_folder
+    path = safe_join(folder, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = None
+    for encoding, extension in ENCODINGS.items():
+        if request.accept_encodings[encoding] and os.path.isfile(
+            path + extension
+        ):
+            response = send_from_directory(
+                folder, filename + extension, mimetype=mimetype
+            )
+            response.headers["Content-Encoding"] = encoding
+            break
+    if response is None:
+        response = send_from_directory(folder, filename, mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+    if HASHED_NAME_REGEX.search(filename):
+        response.headers["Cache-Control"] = IMMUTABLE
+    return response
+
+
+def init_app(app):
+    """Serve an app's static files, and add the compress-assets command."""
+    # Replace Flask's view for the static folder.
+    app.view_functions["static"] = send_static
+    app.cli.add_command(compress_assets_command)
+
+
+def render_index(username):
+    """Render the index page for the current request."""
+    jinja_env = current_app.jinja_env
+    template = jinja_env.get_template("index.html")
+    with index_lock:
+        if index_cache[0] is not template or not template.is_up_to_date:
+            index_cache[:] = template, render_shell()
+        shell = index_cache[1]
+    # The template puts the nonce in as is, and the rest as JSON.
+    nonce = jinja_env.globals["csp_nonce"]()
+    csrf_token = jinja_env.globals["csrf_token"]()
+    shell = shell.replace(NONCE_PLACEHOLDER, nonce)
+    shell = shell.replace(as_json(CSRF_PLACEHOLDER), as_json(csrf_token))
+    return shell.replace(as_json(USERNAME_PLACEHOLDER), as_json(username))
+
+
+def render_shell():
+    """Render the index page with placeholders for per-request values."""
+    return render_template(
+        "index.html",
+        csp_nonce=lambda: NONCE_PLACEHOLDER,
+        csrf_token=lambda: CSRF_PLACEHOLDER,
+        username=USERNAME_PLACEHOLDER,
+    )
+
+
+@click.command("compress-assets")
+@with_appcontext
+def compress_assets_command():
+    """Write compressed copies of the built static files."""
+    folder = current_app.static_folder
+    written = 0
+    for directory, _, filenames in os.walk(folder):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if should_compress(path):
+                compress_file(path)
+                written += 1
+    click.echo(f"Compressed {written} files in {folder}")
+
+
+def should_compress(path):
+    extension = os.path.splitext(path)[1]
+    if extension in ENCODINGS.values():
+        return False
+    if extension.lower() in COMPRESSED_EXTENSIONS:
+        return False
+    return os.path.getsize(path) >= MIN_COMPRESS_SIZE
+
+
+def compress_file(path):
+    """Write gzip and (if available) brotli versions of a file."""
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path + ENCODINGS["gzip"], "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9))
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + ENCODINGS["br"], "wb") as f:
+        f.write(brotli.compress(data, quality=11))
@@ -0,0 +1,111 @@
+"""This module provides in-process caches."""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """A thread-safe cache that evicts the least recently used entries.
+
+    Entries are evicted once there are more than max_entries of them, or once
+    their total size (as measured by the sizeof function) exceeds max_size.
+    If ttl is given, entries also expire after that many seconds.
+
+    If metrics is given (see mira.metrics.CacheMetrics), it is told about
+    hits, misses, evictions, and changes in size.
+    """
+
+    def __init__(
+        self,
+        max_entries=None,
+        max_size=None,
+        sizeof=None,
+        ttl=None,
+        metrics=None,
+    ):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self.metrics = metrics
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.size = 0
+
+    def get(self, key, default=None):
+        """Return the value for a key, or the default if it is missing."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[2] is not None and entry[2] <= monotonic():
+                self.remove_locked(key)
+                self.resized()
+                entry = None
+            if self.metrics:
+                self.metrics.lookup(hit=bool(entry))
+            if not entry:
+                return default
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Store a value, evicting old entries if the cache is full.
+
+        The ttl overrides the cache's default TTL for this entry.
+        """
+        size = self.sizeof(value)
+        if self.max_size is not None and size > self.max_size:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else monotonic() + ttl
+        with self.lock:
+            self.remove_locked(key)
+            self.entries[key] = value, size, expires
+            self.size += size
+            while self.is_full():
+                self.remove_locked(next(iter(self.entries)))
+                if self.metrics:
+                    self.metrics.evicted()
+            self.resized()
+
+    def get_or_create(self, key, create):
+        """Return the value for a key, calling create() if it is missing."""
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            # Don't hold the lock while creating, since that might be slow.
+            value = create()
+            self.set(key, value)
+        return value
+
+    def remove(self, key):
+        """Remove the entry for a key, if there is one."""
+        with self.lock:
+            self.remove_locked(key)
+            self.resized()
+
+    def remove_locked(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
+
+    def is_full(self):
+        if self.max_entries is not None and len(self) > self.max_entries:
+            return True
+        return self.max_size is not None and self.size > self.max_size
+
+    def resized(self):
+        if self.metrics:
+            self.metrics.resized(len(self.entries), self.size)
+
+    def clear(self):
+        """Remove all entries."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.resized()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+MISSING = object()
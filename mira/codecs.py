@@ -0,0 +1,137 @@
+"""This module provides formats for storing canvas images.
+
+Each stored canvas is tagged with the name of its codec, so the configured
+codec can change without breaking rows written under an older one. Clients
+always get PNG, which is transcoded from other formats when needed.
+
+Pillow is slow to import, so it's only imported to create images.
+"""
+
+from io import BytesIO
+import struct
+import zlib
+
+
+class PNGCodec:
+    """Codec for PNG images, which clients can use as is."""
+
+    def encode(self, image, level=None):
+        """Encode an image, at the given compression level if any."""
+        options = {} if level is None else {"compress_level": level}
+        data = BytesIO()
+        image.save(data, "PNG", **options)
+        return data.getvalue()
+
+    def decode(self, data):
+        """Decode an image."""
+        from PIL import Image
+
+        image = Image.open(BytesIO(data))
+        image.load()
+        return image
+
+
+class WebPCodec:
+    """Codec for lossless WebP images.
+
+    The level is the compression method, from 0 (fastest) to 6 (smallest).
+    """
+
+    def encode(self, image, level=None):
+        data = BytesIO()
+        image.convert("RGBA").save(
+            data,
+            "WEBP",
+            lossless=True,
+            quality=100,
+            method=4 if level is None else level,
+        )
+        return data.getvalue()
+
+    def decode(self, data):
+        from PIL import Image
+
+        image = Image.open(BytesIO(data))
+        image.load()
+        return image
+
+
+class RawCodec:
+    """Codec for raw RGBA pixels, after a header with the image size.
+
+    Subclasses compress the pixels. This skips PNG's filtering, so it encodes
+    faster, at some cost in size.
+    """
+
+    header = struct.Struct(">HH")
+
+    def encode(self, image, level=None):
+        pixels = image.convert("RGBA").tobytes()
+        return self.header.pack(*image.size) + self.compress(pixels, level)
+
+    def decode(self, data):
+        from PIL import Image
+
+        size = self.header.unpack_from(data)
+        start = self.header.size
+        pixels = self.decompress(data[start:])
+        return Image.frombytes("RGBA", size, pixels)
+
+
+class ZlibCodec(RawCodec):
+    """Codec for raw RGBA pixels compressed with zlib."""
+
+    def compress(self, pixels, level=None):
+        return zlib.compress(pixels, -1 if level is None else level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCodec(RawCodec):
+    """Codec for raw RGBA pixels compressed with Zstandard."""
+
+    def compress(self, pixels, level=None):
+        import zstandard
+
+        compressor = zstandard.ZstdCompressor(3 if level is None else level)
+        return compressor.compress(pixels)
+
+    def decompress(self, data):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {
+    "png": PNGCodec(),
+    "webp": WebPCodec(),
+    "rgba+zlib": ZlibCodec(),
+    "rgba+zstd": ZstdCodec(),
+}
+
+# The format sent to clients.
+WIRE_FORMAT = "png"
+
+
+def get_codec(name):
+    """Get a codec by name."""
+    if name not in CODECS:
+        raise ValueError(f"Unsupported canvas codec: {name}")
+    return CODECS[name]
+
+
+def check_codec(name, level=None):
+    """Raise ValueError unless a codec works here at the given level.
+
+    WebP needs Pillow built with it, and rgba+zstd needs zstandard, so this
+    round-trips a tiny image to find out.
+    """
+    from PIL import Image
+
+    codec = get_codec(name)
+    try:
+        codec.decode(codec.encode(Image.new("RGBA", (1, 1)), level))
+    except Exception as ex:
+        # Pillow and the compression libraries fail in different ways.
+        raise ValueError(f"Canvas codec {name} doesn't work here: {ex!r}")
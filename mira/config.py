@@ -17,6 +17,8 @@ ENVIRONMENTS = {
         "CSRF_COOKIE_HTTPONLY": True,
         "REMEMBER_COOKIE_HTTPONLY": True,
         "SESSION_COOKIE_HTTPONLY": True,
+        # Leave out image/png and application/octet-stream, since canvas data
+        # is already compressed.
         "COMPRESS_MIMETYPES": [
             "text/html",
             "text/css",
@@ -24,6 +26,79 @@ ENVIRONMENTS = {
             "application/javascript",
             "image/svg+xml",
         ],
+        # Number of faded canvas renders to keep in memory per process.
+        "CANVAS_FADE_CACHE_ENTRIES": 64,
+        # Memory for decoded canvas images to keep per process.
+        "CANVAS_IMAGE_CACHE_BYTES": 64 * 1024 * 1024,
+        # Engine for fading and compositing canvases ("pil" or "numpy").
+        "CANVAS_COMPOSITOR": "pil",
+        # How to store canvas data: "png", "webp" (lossless), "rgba+zlib", or
+        # "rgba+zstd". Each row records its codec, so changing this only
+        # affects canvases as they are next written. Clients always get PNG.
+        "CANVAS_CODEC": "png",
+        # Compression level for the codec, or None for the codec's default.
+        # PNG at level 1 encodes about twice as fast as at the default level,
+        # for blobs about 10% bigger.
+        "CANVAS_CODEC_LEVEL": 1,
+        # Canvases are cleared once fading leaves no pixel with more alpha than
+        # this. Rounding can otherwise keep faint pixels around forever.
+        "CANVAS_VISIBLE_ALPHA": 8,
+        # Thumbnails are rendered in the background, after the canvas has been
+        # quiet for the debounce period (but no later than the maximum delay).
+        "THUMBNAIL_WORKERS": 2,
+        "THUMBNAIL_DEBOUNCE_SECONDS": 2,
+        "THUMBNAIL_MAX_DELAY_SECONDS": 10,
+        # How to deliver change notifications to long-polling requests
+        # ("memory" for a single process, or "postgres" for LISTEN/NOTIFY).
+        # By default, this is "postgres" when serving several workers from a
+        # Postgres database.
+        "NOTIFY_BACKEND": None,
+        # How many requests may wait at once per process. Other requests
+        # return without waiting. On mira.server's wait listener, a waiting
+        # request only holds a socket, but under flask run it holds a thread.
+        "NOTIFY_MAX_WAITERS": 1000,
+        "NOTIFY_MAX_WAIT_SECONDS": 25,
+        # Cache of logged-in users per process, used for reads with the
+        # postgres notification backend. Revoked logins are evicted right
+        # away, but the TTL bounds staleness if a notification is lost.
+        "USER_CACHE_ENTRIES": 1024,
+        "USER_CACHE_TTL_SECONDS": 60,
+        # Cache of friends list responses per process. Entries are evicted
+        # when friendships change, and the TTL bounds staleness otherwise.
+        "FRIENDS_CACHE_ENTRIES": 1024,
+        "FRIENDS_CACHE_TTL_SECONDS": 60,
+        # Werkzeug hash method for new passwords. Existing hashes are upgraded
+        # when their users next log in.
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:150000",
+        # Passwords are hashed in worker processes. Requests beyond the
+        # pending limit get 503 Service Unavailable instead of queueing.
+        "PASSWORD_HASH_WORKERS": 2,
+        "PASSWORD_HASH_MAX_PENDING": 8,
+        # Where to count rate limit hits: "memory://" for a single process,
+        # or a sqlite:// or postgresql:// URL to share limits between workers.
+        # By default, this is the database when serving several workers from
+        # a Postgres database.
+        "RATELIMIT_STORAGE_URL": None,
+        # Don't fail requests if the rate limit storage is unavailable.
+        "RATELIMIT_SWALLOW_ERRORS": True,
+        # Processes and threads per process for mira.server. Each thread can
+        # hold a database connection, so keep the pool at least this big.
+        # Several workers need state shared through the database (see
+        # NOTIFY_BACKEND and RATELIMIT_STORAGE_URL).
+        "SERVER_WORKERS": 2,
+        "SERVER_THREADS": 8,
+        # Database connection pool for each process (Postgres only).
+        "DB_POOL_SIZE": 5,
+        "DB_MAX_OVERFLOW": 5,
+        "DB_POOL_RECYCLE_SECONDS": 1800,
+        "DB_POOL_PRE_PING": True,
+        "DB_STATEMENT_TIMEOUT_MS": 30000,
+        # If set, /metrics requires this in an "Authorization: Bearer" header.
+        # If not, /metrics is only served in debug mode.
+        "METRICS_TOKEN": None,
+        # Fail requests that exceed their query budgets, and report query
+        # counts in an X-Query-Count header.
+        "QUERY_BUDGETS_ENFORCED": False,
     },
     "development": {
         "DEBUG": True,
@@ -39,6 +114,17 @@ ENVIRONMENTS = {
         "CSRF_DISABLE": True,
         # The API tests send requests as fast as possible.
         "RATELIMIT_ENABLED": False,
+        # Render thumbnails right away so that tests are deterministic.
+        "THUMBNAIL_WORKERS": 0,
+        "QUERY_BUDGETS_ENFORCED": True,
+    },
+    # Like production, but served over plain HTTP to a load-testing client
+    # that sends requests as fast as it can.
+    "benchmark": {
+        "DEBUG": False,
+        "FORCE_HTTPS": False,
+        "CSRF_DISABLE": True,
+        "RATELIMIT_ENABLED": False,
     },
     "production": {
         "DEBUG": False,
@@ -48,12 +134,30 @@ ENVIRONMENTS = {
     },
 }
 
+# Settings without defaults, and the environment variables that set them.
+REQUIRED = {
+    "SECRET_KEY": "FLASK_SECRET_KEY",
+    "SQLALCHEMY_DATABASE_URI": "DATABASE_URL",
+}
+
+
+def get_config(env, overrides=None):
+    """Get the configuration for a given environment.
 
-def get_config(env):
-    """Get the configuration for a given environment."""
+    Overrides take precedence over everything else, and are applied before
+    deriving the settings that depend on others.
+    """
     if env not in ENVIRONMENTS:
         raise ValueError(f"Unsupported environment: {env}")
-    config = {**ENVIRONMENTS["base"], **ENVIRONMENTS[env], **get_user_config()}
+    config = {
+        **ENVIRONMENTS["base"],
+        **ENVIRONMENTS[env],
+        **get_user_config(),
+        **(overrides or {}),
+    }
+    for key, name in REQUIRED.items():
+        if key not in config:
+            raise ValueError(f"Environment variable not found: {name}")
     process_config(config)
     return config
 
@@ -62,8 +166,30 @@ def get_user_config():
     """Get the user configuration from environment variables."""
     config = {
         "FORCE_HTTPS": getenv("FLASK_FORCE_HTTPS", parse=parse_bool),
-        "SECRET_KEY": getenv("FLASK_SECRET_KEY", required=True),
-        "SQLALCHEMY_DATABASE_URI": getenv("DATABASE_URL", required=True),
+        "CANVAS_COMPOSITOR": getenv("FLASK_CANVAS_COMPOSITOR"),
+        "CANVAS_CODEC": getenv("FLASK_CANVAS_CODEC"),
+        "CANVAS_CODEC_LEVEL": getenv(
+            "FLASK_CANVAS_CODEC_LEVEL", parse=parse_int
+        ),
+        "NOTIFY_BACKEND": getenv("FLASK_NOTIFY_BACKEND"),
+        "NOTIFY_MAX_WAITERS": getenv(
+            "FLASK_NOTIFY_MAX_WAITERS", parse=parse_int
+        ),
+        "RATELIMIT_STORAGE_URL": getenv("FLASK_RATELIMIT_STORAGE_URL"),
+        "SERVER_WORKERS": getenv("FLASK_SERVER_WORKERS", parse=parse_int),
+        "SERVER_THREADS": getenv("FLASK_SERVER_THREADS", parse=parse_int),
+        "DB_POOL_SIZE": getenv("FLASK_DB_POOL_SIZE", parse=parse_int),
+        "DB_MAX_OVERFLOW": getenv("FLASK_DB_MAX_OVERFLOW", parse=parse_int),
+        "DB_POOL_RECYCLE_SECONDS": getenv(
+            "FLASK_DB_POOL_RECYCLE_SECONDS", parse=parse_int
+        ),
+        "DB_POOL_PRE_PING": getenv("FLASK_DB_POOL_PRE_PING", parse=parse_bool),
+        "DB_STATEMENT_TIMEOUT_MS": getenv(
+            "FLASK_DB_STATEMENT_TIMEOUT_MS", parse=parse_int
+        ),
+        "METRICS_TOKEN": getenv("FLASK_METRICS_TOKEN"),
+        "SECRET_KEY": getenv("FLASK_SECRET_KEY"),
+        "SQLALCHEMY_DATABASE_URI": getenv("DATABASE_URL"),
     }
     return {k: v for k, v in config.items() if v is not None}
 
@@ -74,6 +200,25 @@ def process_config(config):
     config["CSRF_COOKIE_SECURE"] = https
     config["REMEMBER_COOKIE_SECURE"] = https
     config["SESSION_COOKIE_SECURE"] = https
+    # Workers can only share notifications and rate limits through Postgres.
+    database_url = config["SQLALCHEMY_DATABASE_URI"]
+    postgres = database_url.startswith("postgres")
+    shared = postgres and config["SERVER_WORKERS"] > 1
+    if config["NOTIFY_BACKEND"] is None:
+        config["NOTIFY_BACKEND"] = "postgres" if shared else "memory"
+    if config["RATELIMIT_STORAGE_URL"] is None:
+        storage = database_url if shared else "memory://"
+        config["RATELIMIT_STORAGE_URL"] = storage
+    # SQLite doesn't use a connection pool or support statement timeouts.
+    if postgres:
+        timeout = config["DB_STATEMENT_TIMEOUT_MS"]
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_MAX_OVERFLOW"],
+            "pool_recycle": config["DB_POOL_RECYCLE_SECONDS"],
+            "pool_pre_ping": config["DB_POOL_PRE_PING"],
+            "connect_args": {"options": f"-c statement_timeout={timeout}"},
+        }
 
 
 def getenv(name, required=False, parse=None):
@@ -86,6 +231,16 @@ def getenv(name, required=False, parse=None):
     return value
 
 
+def parse_int(name, value):
+    """Parse an environment variable value as an integer."""
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(
+            f"Invalid integer environment variable: {name}={value}"
+        )
+
+
 def parse_bool(name, value):
     """Parse an environment variable value as a boolean."""
     value = value.lower()
@@ -14,3 +14,13 @@ class InvalidAttribute(Exception):
             f"Invalid value '{self.value}' for attribute '{self.attribute}'"
             f": {self.message}"
         )
+
+
+class ServerBusy(Exception):
+    """Error for when the server is too busy to handle a request."""
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
@@ -1,16 +1,15 @@
-"""This module defines global Flask extensions."""
+"""This module defines global Flask extensions, and sets them up for apps."""
+
+import os
 
 from flask_compress import Compress
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_login.login_manager import LoginManager
-from flask_migrate import Migrate
 from flask_seasurf import SeaSurf
 from flask_sqlalchemy import SQLAlchemy
 from flask_talisman import Talisman
 
-from mira import app
-
 
 CONTENT_SECURITY_POLICY = {
     "default-src": "'self'",
@@ -22,27 +21,56 @@ CONTENT_SECURITY_POLICY = {
     "style-src": "'self' fonts.googleapis.com *.gstatic.com",
 }
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login_manager = LoginManager(app)
-limiter = Limiter(app, key_func=get_remote_address)
-compress = Compress(app)
-csrf = SeaSurf(app)
-talisman = Talisman(
-    app,
-    force_https=app.config["FORCE_HTTPS"],
-    session_cookie_secure=app.config["SESSION_COOKIE_SECURE"],
-    content_security_policy=CONTENT_SECURITY_POLICY,
-    content_security_policy_nonce_in=["script-src"],
-)
-
-if app.debug:
+db = SQLAlchemy()
+login_manager = LoginManager()
+limiter = Limiter(key_func=get_remote_address)
+compress = Compress()
+csrf = SeaSurf()
+talisman = Talisman()
+
+
+def init_app(app):
+    """Set up the extensions for an app."""
+    db.init_app(app)
+    if os.getenv("FLASK_RUN_FROM_CLI") == "true":
+        # Only the flask db commands need this, and it's slow to import.
+        from flask_migrate import Migrate
+
+        Migrate(app, db)
+    login_manager.init_app(app)
+    # Register SQL rate limit storage, which needs the db.
+    import mira.ratelimit  # noqa
+
+    limiter.init_app(app)
+    compress.init_app(app)
+    csrf.init_app(app)
+    talisman.init_app(
+        app,
+        force_https=app.config["FORCE_HTTPS"],
+        session_cookie_secure=app.config["SESSION_COOKIE_SECURE"],
+        content_security_policy=CONTENT_SECURITY_POLICY,
+        content_security_policy_nonce_in=["script-src"],
+    )
+    if app.debug:
+        init_debug(app)
+
+
+def init_debug(app):
     # Enable cross-origin requests in debug mode, since we serve the Vue app on
     # a different port with webpack-dev-server.
     from flask_cors import CORS
 
     CORS(
-        app, supports_credentials=True, resources={r"/api/*": {"origins": "*"}}
+        app,
+        supports_credentials=True,
+        resources={r"/api/*": {"origins": "*"}},
+        expose_headers=[
+            "ETag",
+            "X-Canvas-Id",
+            "X-Canvas-Version",
+            "X-Canvas-Fade",
+            "X-Canvas-Offset",
+        ],
     )
 
     # Log all database queries in debug mode.
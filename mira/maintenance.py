@@ -0,0 +1,236 @@
+"""This module provides maintenance commands to run on a schedule.
+
+Canvases only fade when someone reads or syncs them, so blobs for canvases
+nobody draws on stay at full size. Run this hourly (once per fade period) to
+apply pending fades, clear canvases that have faded out, and delete canvases
+that no friendship refers to anymore:
+
+    flask fade-canvases
+
+Faded canvases get a new version, so clients see them on their next poll.
+With the postgres notification backend, long-polling clients hear about them
+right away. Other backends can't reach the server's processes, so this
+doesn't notify at all.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from hashlib import sha256
+from time import monotonic
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import exists
+
+from mira.codecs import get_codec
+from mira.compositing import get_compositor
+from mira.extensions import db
+from mira.models import (
+    CANVAS_BOX,
+    FADE_MULTIPLIER,
+    FADE_PERIOD,
+    Canvas,
+    Friendship,
+    decode_canvas,
+    encode_image,
+    next_change,
+)
+from mira.notifications import (
+    canvas_topic,
+    cross_process,
+    friends_topic,
+    notify,
+)
+
+
+# Settings that fade_blobs needs, since worker processes have no app.
+FADE_SETTINGS = (
+    "CANVAS_COMPOSITOR",
+    "CANVAS_CODEC",
+    "CANVAS_CODEC_LEVEL",
+    "CANVAS_VISIBLE_ALPHA",
+)
+
+
+def init_app(app):
+    """Add the maintenance commands to an app."""
+    app.cli.add_command(fade_canvases_command)
+
+
+@click.command("fade-canvases")
+@click.option("--batch-size", default=100, help="Canvases to load at once.")
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    help="Processes to fade canvases in (0 to fade in this process).",
+)
+@with_appcontext
+def fade_canvases_command(batch_size, workers):
+    """Apply pending fades and delete faded or orphaned canvases."""
+    start = monotonic()
+    orphans = delete_orphaned_canvases()
+    stats = fade_canvases(batch_size, workers)
+    seconds = monotonic() - start
+    rate = stats["canvases"] / seconds if seconds else 0
+    click.echo(f"Deleted {orphans} orphaned canvases")
+    click.echo(
+        f"Faded {stats['faded']} and cleared {stats['cleared']} of "
+        f"{stats['canvases']} canvases ({stats['skipped']} changed meanwhile)"
+    )
+    click.echo(f"Reclaimed {stats['reclaimed_bytes']} bytes")
+    click.echo(f"Took {seconds:.1f} seconds ({rate:.1f} canvases/second)")
+
+
+def delete_orphaned_canvases():
+    """Delete canvases that no friendship refers to, and return how many."""
+    referenced = exists().where(Friendship.canvas_id == Canvas.id)
+    deleted = Canvas.query.filter(~referenced).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return deleted
+
+
+def fade_canvases(batch_size, workers):
+    """Fade every canvas with pending fades, in batches of the given size.
+
+    Returns counts of what happened to the canvases.
+    """
+    stats = dict.fromkeys(
+        ["canvases", "faded", "cleared", "skipped", "reclaimed_bytes"], 0
+    )
+    settings = {name: current_app.config[name] for name in FADE_SETTINGS}
+    executor = ProcessPoolExecutor(workers) if workers else None
+    last_id = 0
+    try:
+        while True:
+            now = datetime.utcnow()
+            rows = (
+                db.session.query(
+                    Canvas.id,
+                    Canvas.version,
+                    Canvas.changes,
+                    Canvas.last_fade,
+                    Canvas.data,
+                    Canvas.data_format,
+                    Canvas.thumbnail,
+                    Canvas.thumbnail_version,
+                )
+                .filter(Canvas.id > last_id)
+                .filter(Canvas.last_fade <= now - FADE_PERIOD)
+                .order_by(Canvas.id)
+                .limit(batch_size)
+                .all()
+            )
+            # Don't hold the transaction open while fading.
+            db.session.commit()
+            if not rows:
+                return stats
+            last_id = rows[-1].id
+            jobs = [
+                (
+                    row.data,
+                    row.data_format,
+                    row.thumbnail,
+                    FADE_MULTIPLIER ** pending_fades(row, now),
+                    settings,
+                )
+                for row in rows
+            ]
+            if executor:
+                results = executor.map(fade_blobs, *zip(*jobs))
+            else:
+                results = (fade_blobs(*job) for job in jobs)
+            for row, (data, data_format, thumbnail) in zip(rows, results):
+                stats["canvases"] += 1
+                if store_faded(row, data, data_format, thumbnail, now):
+                    stats["faded" if data else "cleared"] += 1
+                    stats["reclaimed_bytes"] += blob_size(
+                        row.data, row.thumbnail
+                    ) - blob_size(data, thumbnail)
+                else:
+                    stats["skipped"] += 1
+            db.session.commit()
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def pending_fades(row, now):
+    return (now - row.last_fade) // FADE_PERIOD
+
+
+def store_faded(row, data, data_format, thumbnail, now):
+    """Save a faded canvas, unless it changed since it was loaded.
+
+    The version is bumped so that cached images of the unfaded canvas go
+    unused. Returns true if the canvas was updated.
+    """
+    if data:
+        values = {
+            "data": data,
+            "data_format": data_format,
+            "last_fade": row.last_fade + pending_fades(row, now) * FADE_PERIOD,
+        }
+        if thumbnail:
+            values["thumbnail"] = thumbnail
+            values["thumbnail_version"] = row.version + 1
+            values["thumbnail_hash"] = sha256(thumbnail).hexdigest()[:16]
+    else:
+        values = {
+            "data": None,
+            "data_format": None,
+            "last_fade": None,
+            "thumbnail": None,
+            "thumbnail_version": None,
+            "thumbnail_hash": None,
+        }
+    values["version"], values["changes"] = next_change(
+        row.version, row.changes, CANVAS_BOX
+    )
+    updated = Canvas.query.filter(
+        Canvas.id == row.id, Canvas.version == row.version
+    ).update(values, synchronize_session=False)
+    if not updated:
+        return False
+    if not cross_process():
+        # Notifications wouldn't leave this process.
+        return True
+    friendships = Friendship.query.filter_by(canvas_id=row.id)
+    notify(
+        canvas_topic(row.id),
+        *(friends_topic(f.friender_id) for f in friendships),
+    )
+    return True
+
+
+def fade_blobs(data, data_format, thumbnail, alpha_multiplier, settings):
+    """Fade a canvas's data and thumbnail (runs in a worker process).
+
+    The data is stored again with the configured codec. Returns the faded
+    (data, data_format, thumbnail), or all None if nothing on the canvas would
+    still be visible.
+    """
+    compositor = get_compositor(settings["CANVAS_COMPOSITOR"])
+    image = fade_image(data, data_format, alpha_multiplier, compositor)
+    visible_alpha = settings["CANVAS_VISIBLE_ALPHA"]
+    if image.getchannel("A").getextrema()[1] < visible_alpha:
+        return None, None, None
+    if thumbnail:
+        thumbnail = encode_image(
+            fade_image(thumbnail, None, alpha_multiplier, compositor)
+        )
+    codec = settings["CANVAS_CODEC"]
+    data = get_codec(codec).encode(image, settings["CANVAS_CODEC_LEVEL"])
+    return data, codec, thumbnail
+
+
+def fade_image(data, data_format, alpha_multiplier, compositor):
+    image = decode_canvas(data, data_format).convert("RGBA")
+    return compositor.fade(image, alpha_multiplier)
+
+
+def blob_size(*blobs):
+    return sum(len(blob) for blob in blobs if blob)
@@ -0,0 +1,238 @@
+"""This module collects Prometheus metrics about requests and canvas work.
+
+When served by mira.server, workers write metrics to files in the directory
+named by the prometheus_multiproc_dir environment variable, so that any
+worker can report totals for all of them.
+
+It also checks that views stay within their declared query budgets, so that
+N+1 query regressions fail the API tests.
+"""
+
+from time import perf_counter
+import os
+
+from flask import current_app, g, has_request_context, jsonify, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+
+from mira.extensions import db
+
+
+# Maximum number of database queries per request, by endpoint.
+QUERY_BUDGETS = {}
+
+BYTE_BUCKETS = tuple(4 ** n for n in range(3, 12))
+QUERY_BUCKETS = 0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32
+
+REQUEST_SECONDS = Histogram(
+    "mira_request_duration_seconds",
+    "Time spent handling requests",
+    ["route", "method"],
+)
+REQUESTS = Counter(
+    "mira_requests_total",
+    "Requests handled, by response status",
+    ["route", "method", "status"],
+)
+REQUEST_QUERIES = Histogram(
+    "mira_request_db_queries",
+    "Database queries per request",
+    ["route", "method"],
+    buckets=QUERY_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "mira_request_db_duration_seconds",
+    "Time spent in database queries per request",
+    ["route", "method"],
+)
+REQUEST_BYTES = Histogram(
+    "mira_request_body_bytes",
+    "Size of request bodies",
+    ["route", "method"],
+    buckets=BYTE_BUCKETS,
+)
+RESPONSE_BYTES = Histogram(
+    "mira_response_body_bytes",
+    "Size of response bodies, before compression",
+    ["route", "method"],
+    buckets=BYTE_BUCKETS,
+)
+CANVAS_SECONDS = Histogram(
+    "mira_canvas_stage_duration_seconds",
+    "Time spent in each stage of canvas processing",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+MIX_REGION_PIXELS = Histogram(
+    "mira_canvas_mix_region_pixels",
+    "Area of the visible part of each layer mixed into a canvas",
+    buckets=tuple(4 ** n for n in range(1, 10)),
+)
+MIX_FADES = Counter(
+    "mira_canvas_mix_fades_total",
+    "Canvas mixes by whether the whole canvas had to be faded",
+    ["outcome"],
+)
+THUMBNAIL_QUEUE_DEPTH = Gauge(
+    "mira_thumbnail_queue_depth",
+    "Thumbnails waiting to be rendered or being rendered",
+    multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "mira_cache_lookups_total",
+    "Lookups in each in-process cache, by whether they hit",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "mira_cache_evictions_total",
+    "Entries evicted from each in-process cache to make room",
+    ["cache"],
+)
+# Each process has its own caches, so add up the live processes.
+CACHE_ENTRIES = Gauge(
+    "mira_cache_entries",
+    "Entries in each in-process cache",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+CACHE_BYTES = Gauge(
+    "mira_cache_bytes",
+    "Size of each in-process cache, for caches that measure it",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+
+
+class CacheMetrics:
+    """Metrics for one of the caches from mira.cache."""
+
+    def __init__(self, name):
+        self.hits = CACHE_LOOKUPS.labels(name, "hit")
+        self.misses = CACHE_LOOKUPS.labels(name, "miss")
+        self.evictions = CACHE_EVICTIONS.labels(name)
+        self.entries = CACHE_ENTRIES.labels(name)
+        self.bytes = CACHE_BYTES.labels(name)
+
+    def lookup(self, hit):
+        (self.hits if hit else self.misses).inc()
+
+    def evicted(self):
+        self.evictions.inc()
+
+    def resized(self, entries, size):
+        self.entries.set(entries)
+        self.bytes.set(size)
+
+
+def timed(stage):
+    """Return a context manager that times a stage of canvas processing."""
+    return CANVAS_SECONDS.labels(stage).time()
+
+
+def record_mix(box, fade_outcome=None):
+    """Record the region a mix composited, and how it dealt with fading.
+
+    The outcome is "skipped" if no fade was due, "cached" if an already faded
+    render was used, or "applied".
+    """
+    MIX_REGION_PIXELS.observe((box[2] - box[0]) * (box[3] - box[1]))
+    if fade_outcome:
+        MIX_FADES.labels(fade_outcome).inc()
+
+
+def query_budget(budget):
+    """Declare the most database queries a view may make per request."""
+
+    def decorator(view):
+        QUERY_BUDGETS[view.__name__] = budget
+        return view
+
+    return decorator
+
+
+def exposition():
+    """Return the metrics in Prometheus text format, and its content type."""
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def route_labels():
+    # Use the URL rule rather than the path, to keep the number of labels low.
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    return rule, request.method
+
+
+def init_app(app):
+    """Record metrics for an app's requests and database queries."""
+    app.before_request(start_request_metrics)
+    app.after_request(record_request_metrics)
+    engine = db.get_engine(app)
+    event.listen(engine, "before_cursor_execute", start_query_metrics)
+    event.listen(engine, "after_cursor_execute", record_query_metrics)
+
+
+def start_request_metrics():
+    g.metrics_start = perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0
+
+
+def record_request_metrics(response):
+    start = g.get("metrics_start")
+    if start is None:
+        return response
+    labels = route_labels()
+    REQUEST_SECONDS.labels(*labels).observe(perf_counter() - start)
+    REQUESTS.labels(*labels, response.status_code).inc()
+    REQUEST_QUERIES.labels(*labels).observe(g.db_queries)
+    REQUEST_DB_SECONDS.labels(*labels).observe(g.db_seconds)
+    if request.content_length:
+        REQUEST_BYTES.labels(*labels).observe(request.content_length)
+    if not response.is_streamed:
+        RESPONSE_BYTES.labels(*labels).observe(response.content_length or 0)
+    if current_app.config["QUERY_BUDGETS_ENFORCED"]:
+        return check_query_budget(response)
+    return response
+
+
+def check_query_budget(response):
+    """Report the query count, replacing the response if over budget."""
+    # Blueprints prefix endpoints with their names, unlike view names.
+    budget = QUERY_BUDGETS.get((request.endpoint or "").rpartition(".")[2])
+    response.headers["X-Query-Count"] = str(g.db_queries)
+    if budget is None or g.db_queries <= budget:
+        return response
+    message = (
+        f"{request.endpoint} made {g.db_queries} queries, "
+        f"but its budget is {budget}"
+    )
+    current_app.logger.error(message)
+    response = jsonify(code="query_budget", message=message)
+    response.status_code = 500
+    response.headers["X-Query-Count"] = str(g.db_queries)
+    return response
+
+
+def start_query_metrics(conn, cursor, statement, parameters, context, many):
+    conn.info["query_start"] = perf_counter()
+
+
+def record_query_metrics(conn, cursor, statement, parameters, context, many):
+    elapsed = perf_counter() - conn.info["query_start"]
+    # Queries from background threads don't belong to any request.
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_seconds += elapsed
@@ -1,28 +1,50 @@
 """This module defines the data models for Mira."""
 
-from base64 import b64encode
 from datetime import datetime, timedelta
 from io import BytesIO
 from uuid import uuid4
 import math
 import re
 
-from PIL import Image
+from flask import current_app, url_for
 from flask_login.mixins import UserMixin
-from sqlalchemy import CheckConstraint, Column, ForeignKey
+from sqlalchemy import CheckConstraint, Column, ForeignKey, and_, event, or_
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import (
+    aliased,
     backref,
+    contains_eager,
     deferred,
     joinedload,
+    make_transient_to_detached,
     relationship,
     validates,
 )
-from sqlalchemy.types import Boolean, DateTime, Integer, LargeBinary, String
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.types import (
+    JSON,
+    Boolean,
+    DateTime,
+    Integer,
+    LargeBinary,
+    String,
+)
 
+from mira.cache import LRUCache
+from mira.codecs import WIRE_FORMAT, get_codec
+from mira.compositing import get_compositor
 from mira.errors import InvalidAttribute
 from mira.extensions import db
+from mira.metrics import CacheMetrics, record_mix, timed
+from mira.notifications import (
+    broker,
+    cross_process,
+    friends_topic,
+    listen,
+    login_topic,
+    notify,
+)
+from mira.passwords import hasher
 
 
 MIN_PASSWORD_LENGTH = 8
@@ -36,10 +58,87 @@ INCOMING_STATE = "incoming"
 OUTGOING_STATE = "outgoing"
 STRANGER_STATE = "stranger"
 
-IMAGE_FORMAT = "PNG"
+CANVAS_SIZE = 500, 500
+CANVAS_BOX = 0, 0, *CANVAS_SIZE
+MAX_CANVAS_CHANGES = 16
 THUMBNAIL_SIZE = 100, 100
 FADE_MULTIPLIER = 0.95
 FADE_PERIOD = timedelta(hours=1)
+FADE_EPOCH = datetime(2019, 1, 1)
+FRIENDS_VIEWS = "friends_lists", "all_friends_data"
+
+# The caches are sized by init_app.
+
+# Faded renders of canvas data and thumbnails, keyed by canvas ID, version,
+# and fade level. This lets readers see faded canvases without DB writes.
+faded_cache = LRUCache(metrics=CacheMetrics("faded"))
+
+# Decoded canvas images, keyed by canvas ID and version. This lets syncs on
+# active canvases skip loading and decoding the blob.
+image_cache = LRUCache(
+    sizeof=lambda image: image.width * image.height * len(image.getbands()),
+    metrics=CacheMetrics("image"),
+)
+
+# Column values of users by login ID, so that authenticated reads don't need
+# a query to load the current user. Revoked logins are evicted through
+# notifications, so this is only used if they reach every process.
+user_cache = LRUCache(metrics=CacheMetrics("user"))
+
+# ETag state and serialized data for each user's friends views, keyed by user
+# ID and view name. This lets polls for unchanged friends skip every query.
+# Like the user cache, this is only used if notifications reach every process.
+friends_cache = LRUCache(metrics=CacheMetrics("friends"))
+
+
+def init_app(app):
+    """Size the caches for an app, and empty them, since its db may differ."""
+    config = app.config
+    faded_cache.max_entries = config["CANVAS_FADE_CACHE_ENTRIES"]
+    image_cache.max_size = config["CANVAS_IMAGE_CACHE_BYTES"]
+    user_cache.max_entries = config["USER_CACHE_ENTRIES"]
+    user_cache.ttl = config["USER_CACHE_TTL_SECONDS"]
+    friends_cache.max_entries = config["FRIENDS_CACHE_ENTRIES"]
+    for cache in faded_cache, image_cache, user_cache, friends_cache:
+        cache.clear()
+
+
+def forget_revoked_login(topic):
+    prefix = login_topic("")
+    if topic.startswith(prefix):
+        user_cache.remove(topic.replace(prefix, "", 1))
+
+
+def forget_changed_friends(topic):
+    prefix = friends_topic("")
+    if topic.startswith(prefix):
+        user_id = int(topic.replace(prefix, "", 1))
+        for view in FRIENDS_VIEWS:
+            friends_cache.remove((user_id, view))
+
+
+broker.subscribe(forget_revoked_login)
+broker.subscribe(forget_changed_friends)
+
+
+def cache_image_on_commit(key, image):
+    """Cache a decoded canvas image once the transaction storing it commits.
+
+    Caching it any earlier could leave an image for a version that never
+    committed, which another writer could then commit with different pixels.
+    """
+    db.session.info.setdefault("images", {})[key] = image
+
+
+@event.listens_for(db.session, "after_commit")
+def cache_committed_images(session):
+    for key, image in session.info.pop("images", {}).items():
+        image_cache.set(key, image)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_rolled_back_images(session):
+    session.info.pop("images", None)
 
 
 class BaseModel(db.Model):
@@ -78,8 +177,14 @@ class User(BaseModel, UserMixin):
 
     def reset_login_id(self):
         """Change the login token to force the user to log in again."""
+        if self.login_id:
+            self.revoke_login_id()
         self.login_id = str(uuid4())
 
+    def revoke_login_id(self):
+        """Evict the login ID from every process's cache on commit."""
+        notify(login_topic(self.login_id))
+
     def set_password(self, password):
         """Reset the user's password (stores only the hash)."""
         if len(password) < MIN_PASSWORD_LENGTH:
@@ -88,11 +193,21 @@ class User(BaseModel, UserMixin):
                 f"[string of length {len(password)}]",
                 f"Password must be at least {MIN_PASSWORD_LENGTH} characters",
             )
-        self.pw_hash = generate_password_hash(password)
+        self.pw_hash = hasher.hash(password)
 
     def check_password(self, password):
         """Check if the given password is correct."""
-        return check_password_hash(self.pw_hash, password)
+        return hasher.check(self.pw_hash, password)
+
+    def upgrade_password(self, password):
+        """Rehash a correct password if the hash method has changed.
+
+        Returns true if the hash changed.
+        """
+        if not hasher.needs_rehash(self.pw_hash):
+            return False
+        self.set_password(password)
+        return True
 
     @validates("username")
     def validate_username(self, key, value):
@@ -104,6 +219,37 @@ class User(BaseModel, UserMixin):
             )
         return value
 
+    @classmethod
+    def by_login_id(cls, login_id, cached=True):
+        """Look up a user by their login ID, using the cache if allowed.
+
+        Pass cached=False for requests that change anything, so that a login
+        revoked a moment ago in another process can't slip through.
+        """
+        if not (cached and cross_process()):
+            return cls.query.filter_by(login_id=login_id).first()
+        listen()
+        values = user_cache.get(login_id)
+        if values is None:
+            topic = login_topic(login_id)
+            token = broker.token(topic)
+            user = cls.query.filter_by(login_id=login_id).first()
+            if user:
+                keys = [attr.key for attr in cls.__mapper__.column_attrs]
+                values = {k: getattr(user, k) for k in keys}
+                # Skip caching if the login was revoked while this loaded.
+                broker.unless_changed(
+                    topic, token, lambda: user_cache.set(login_id, values)
+                )
+            return user
+        # Rebuild the user without a query, and attach it to the session.
+        user = cls.__mapper__.class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        db.session.add(user)
+        return user
+
     @classmethod
     def by_name(cls, username):
         """Look up a user by their username."""
@@ -135,26 +281,143 @@ class User(BaseModel, UserMixin):
             data["time"] = friendship.updated_at.isoformat() + "Z"
         if state == FRIEND_STATE:
             canvas = friendship.canvas
-            thumbnail = canvas and canvas.thumbnail
-            data["thumbnail"] = (
-                b64encode(thumbnail).decode() if thumbnail else None
+            key = canvas and canvas.thumbnail_key()
+            data["thumbnail"] = key and url_for(
+                "views.get_thumbnail", username=self.username, key=key
             )
         return data
 
-    def friend_data(self, user):
-        """Return data about a particular friend."""
-        if self == user:
-            return user.serialize(SELF_STATE)
-        outgoing = (
-            Friendship.between(self, user, query=True)
-            .options(joinedload(Friendship.canvas).undefer(Canvas.thumbnail))
-            .first()
+    def delete(self):
+        """Delete this user, their friendships, and their canvases.
+
+        This uses bulk deletes, rather than loading each friendship and canvas
+        to cascade the delete through the session.
+        """
+        involving = or_(
+            Friendship.friender_id == self.id, Friendship.friendee_id == self.id
+        )
+        canvas_ids = db.session.query(Friendship.canvas_id).filter(involving)
+        Canvas.query.filter(Canvas.id.in_(canvas_ids.subquery())).delete(
+            synchronize_session=False
+        )
+        Friendship.query.filter(involving).delete(synchronize_session=False)
+        User.query.filter_by(id=self.id).delete(synchronize_session=False)
+
+    def involved_user_ids(self):
+        """Return IDs of users with friendships involving this user."""
+        rows = db.session.query(
+            Friendship.friender_id, Friendship.friendee_id
+        ).filter(
+            or_(
+                Friendship.friender_id == self.id,
+                Friendship.friendee_id == self.id,
+            )
         )
-        incoming = (
-            Friendship.between(user, self, query=True)
-            .filter_by(ignored=False)
+        return {user_id for row in rows for user_id in row}
+
+    def friends_view(self, view):
+        """Return ETag state and data for a friends view, caching both.
+
+        The view is the name of a method in FRIENDS_VIEWS. Entries are evicted
+        when the user's friends topic is published, and expire when a canvas
+        fade next changes a thumbnail key.
+        """
+        if not cross_process():
+            return self.load_friends_view(view, datetime.utcnow())[:2]
+        key = self.id, view
+        cached = friends_cache.get(key)
+        if cached:
+            return cached
+        # Make sure this process hears about changes made by other processes.
+        listen()
+        topic = friends_topic(self.id)
+        token = broker.token(topic)
+        now = datetime.utcnow()
+        state, data, rows = self.load_friends_view(view, now)
+        ttl = current_app.config["FRIENDS_CACHE_TTL_SECONDS"]
+        for _, canvas in rows:
+            fade = canvas and canvas.thumbnail_hash and canvas.next_fade(now)
+            if fade:
+                ttl = min(ttl, (fade - now).total_seconds())
+        # Skip caching if a change was published while this was loading.
+        broker.unless_changed(
+            topic, token, lambda: friends_cache.set(key, (state, data), ttl)
+        )
+        return state, data
+
+    def load_friends_view(self, view, now):
+        """Return ETag state, data, and friendship rows for a friends view."""
+        rows = self.friendships_with_canvases().all()
+        state = [friendship_state(*row, now) for row in rows]
+        return state, getattr(self, view)(), rows
+
+    def friendships_with_canvases(self):
+        """Query friendships involving this user, without loading blobs."""
+        return (
+            db.session.query(Friendship, Canvas)
+            .outerjoin(Friendship.canvas)
+            .filter(
+                or_(
+                    Friendship.friender_id == self.id,
+                    Friendship.friendee_id == self.id,
+                )
+            )
+            .order_by(Friendship.friender_id, Friendship.friendee_id)
+        )
+
+    def relation(self, username, canvas=False):
+        """Look up a user and the friendships to and from them in one query.
+
+        Returns None if no user has that username. If canvas is true, this also
+        loads the canvas for the outgoing friendship (but not its blobs).
+        """
+        outgoing = aliased(Friendship)
+        incoming = aliased(Friendship)
+        query = (
+            db.session.query(User, outgoing, incoming)
+            .outerjoin(
+                outgoing,
+                and_(
+                    outgoing.friender_id == self.id,
+                    outgoing.friendee_id == User.id,
+                ),
+            )
+            .outerjoin(
+                incoming,
+                and_(
+                    incoming.friender_id == User.id,
+                    incoming.friendee_id == self.id,
+                ),
+            )
+            .filter(User.username == username)
+        )
+        if canvas:
+            query = query.outerjoin(outgoing.canvas).options(
+                contains_eager(outgoing.canvas)
+            )
+        row = query.first()
+        return row and Relation(*row)
+
+    def shared_canvas(self, username):
+        """Return the canvas shared with a user, locked for update, or None."""
+        return (
+            Canvas.query.join(Canvas.friendships)
+            .join(User, User.id == Friendship.friendee_id)
+            .filter(Friendship.friender_id == self.id)
+            .filter(User.username == username)
+            .with_for_update(of=Canvas)
             .first()
         )
+
+    def friend_data(self, relation):
+        """Return data about a particular friend."""
+        user = relation.user
+        if self == user:
+            return user.serialize(SELF_STATE)
+        outgoing = relation.friendship
+        incoming = relation.reverse_friendship
+        if incoming and incoming.ignored:
+            incoming = None
         if outgoing and incoming:
             return user.serialize(FRIEND_STATE, outgoing)
         if outgoing and not incoming:
@@ -163,11 +426,47 @@ class User(BaseModel, UserMixin):
             return user.serialize(INCOMING_STATE, incoming)
         return user.serialize(STRANGER_STATE)
 
+    def friends_lists(self):
+        """Return usernames of friends and pending friend requests.
+
+        This is like calling friends(), incoming_friend_requests(), and
+        outgoing_friend_requests(), but with one query instead of one per user.
+        """
+        rows = (
+            db.session.query(Friendship.friender_id, User.username)
+            .join(
+                User,
+                or_(
+                    User.id == Friendship.friender_id,
+                    User.id == Friendship.friendee_id,
+                ),
+            )
+            .filter(
+                or_(
+                    Friendship.friender_id == self.id,
+                    Friendship.friendee_id == self.id,
+                )
+            )
+            .filter(User.id != self.id)
+        )
+        outgoing = set()
+        incoming = set()
+        for friender_id, username in rows:
+            if friender_id == self.id:
+                outgoing.add(username)
+            else:
+                incoming.add(username)
+        return {
+            "friends": sorted(outgoing & incoming),
+            "incoming_requests": sorted(incoming - outgoing),
+            "outgoing_requests": sorted(outgoing - incoming),
+        }
+
     def all_friends_data(self):
         """Return data about all friends."""
         outgoing = self.outgoing_friendships.options(
             joinedload(Friendship.friendee),
-            joinedload(Friendship.canvas).undefer(Canvas.thumbnail),
+            joinedload(Friendship.canvas),
         )
         incoming = self.incoming_friendships.options(
             joinedload(Friendship.friender)
@@ -218,10 +517,17 @@ class Friendship(BaseModel):
     friender_id = Column(
         Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
     )
+    # The primary key index only helps lookups by friender_id, so index the
+    # other columns friendships are looked up by.
     friendee_id = Column(
-        Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    canvas_id = Column(
+        Integer, ForeignKey("canvases.id", ondelete="SET NULL"), index=True
     )
-    canvas_id = Column(Integer, ForeignKey("canvases.id", ondelete="SET NULL"))
     ignored = Column(Boolean, nullable=False, default=False)
 
     friender = relationship(
@@ -264,6 +570,25 @@ class Friendship(BaseModel):
         return f"<Friendship {self.friender_id},{self.friendee_id}>"
 
 
+class Relation:
+    """A user along with the friendships to and from them."""
+
+    def __init__(self, user, friendship, reverse_friendship):
+        self.user = user
+        self.friendship = friendship
+        self.reverse_friendship = reverse_friendship
+
+    def state(self, now=None):
+        """Return cheap state that changes whenever friend data changes."""
+        state = [None, None]
+        if self.friendship:
+            canvas = self.friendship.canvas
+            state[0] = friendship_state(self.friendship, canvas, now)
+        if self.reverse_friendship:
+            state[1] = friendship_state(self.reverse_friendship, None, now)
+        return state
+
+
 class Canvas(BaseModel):
     """A canvas shared between two friends."""
 
@@ -271,35 +596,338 @@ class Canvas(BaseModel):
 
     id = Column(Integer, primary_key=True)
     thumbnail = deferred(Column(LargeBinary))
+    # The version the thumbnail was rendered from. It can lag behind version,
+    # since thumbnails are rendered in the background.
+    thumbnail_version = Column(Integer)
+    thumbnail_hash = Column(String)
     data = deferred(Column(LargeBinary))
+    # The codec the data is stored with. Rows from before codecs have NULL,
+    # which means PNG.
+    data_format = Column(String)
     last_fade = Column(DateTime)
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # Recent changes as [version, left, upper, right, lower] lists, oldest
+    # first. This lets us send clients only the region they haven't seen.
+    changes = Column(JSON)
+
+    def mix(self, new_data, offset=(0, 0)):
+        """Paste a layer onto the canvas at the given offset.
+
+        Returns the composited image, which is shared with the image cache,
+        or None if the layer is fully transparent and the canvas is left as
+        it is. This does not update the thumbnail (see mira.thumbnails).
+        """
+        # Pillow is slow to import, so wait until a canvas needs it.
+        from PIL import Image
 
-    def mix(self, new_data):
         now = datetime.utcnow()
-        if not self.data:
-            self.data = new_data
+        try:
+            with timed("decode"):
+                new_image = Image.open(BytesIO(new_data))
+                new_image.load()
+        except OSError:
+            raise InvalidAttribute(
+                "data", f"[{len(new_data)} bytes]", "Data is not an image"
+            )
+        left, upper = offset
+        upload_box = (
+            left,
+            upper,
+            left + new_image.width,
+            upper + new_image.height,
+        )
+        if not contains(CANVAS_BOX, upload_box):
+            raise InvalidAttribute(
+                "offset", list(offset), "Layer does not fit in the canvas"
+            )
+        # Only the layer's visible pixels can change the canvas, so composite
+        # just those, and tell clients that only that region changed.
+        layer, box = crop_visible(new_image, upload_box)
+        if layer is None:
+            return None
+        offset = box[:2]
+        # Check last_fade rather than data, to avoid loading the blob.
+        if not self.last_fade:
+            if upload_box == CANVAS_BOX and new_image.format == "PNG":
+                # Keep the upload as is, rather than encoding it again.
+                self.data = new_data
+                self.data_format = "png"
+                image = new_image
+            else:
+                image = Image.new("RGBA", CANVAS_SIZE)
+                image.paste(layer, offset)
+                self.store_image(image)
+            record_mix(box)
             self.last_fade = now
-            image = Image.open(BytesIO(new_data))
         else:
-            image = Image.open(BytesIO(self.data))
-            blank = image.copy()
-            blank.putalpha(0)
-            elapsed = now - self.last_fade
-            if elapsed >= FADE_PERIOD:
-                num_periods = math.floor(elapsed / FADE_PERIOD)
-                alpha_multiplier = FADE_MULTIPLIER ** num_periods
-                image = Image.blend(blank, image, alpha_multiplier)
+            num_periods = self.pending_fades(now)
+            alpha_multiplier = FADE_MULTIPLIER ** num_periods
+            # Start from the cached decoded image if possible, which avoids
+            # loading the blob at all. Failing that, use the faded render if
+            # readers have already cached it. Otherwise, decode the blob and
+            # fade it as part of compositing.
+            image = self.cached_image()
+            faded_data = image is None and faded_cache.get(
+                self.faded_key("data", now)
+            )
+            if image:
+                image = image.copy()
+            elif faded_data:
+                with timed("decode"):
+                    image = decode_canvas(faded_data, WIRE_FORMAT)
+                alpha_multiplier = 1
+            else:
+                data = self.data
+                with timed("decode"):
+                    image = decode_canvas(data, self.data_format)
+            if alpha_multiplier != 1:
+                record_mix(box, "applied")
+            else:
+                record_mix(box, "cached" if num_periods else "skipped")
+            if num_periods:
                 self.last_fade += num_periods * FADE_PERIOD
-            new_image = Image.open(BytesIO(new_data))
-            data_bytes = BytesIO()
-            image.paste(new_image, (0, 0), mask=new_image)
-            image.save(data_bytes, IMAGE_FORMAT)
-            self.data = data_bytes.getvalue()
-        thumbnail_bytes = BytesIO()
-        image.thumbnail(THUMBNAIL_SIZE, Image.BICUBIC)
-        image.save(thumbnail_bytes, IMAGE_FORMAT)
-        self.thumbnail = thumbnail_bytes.getvalue()
-        return self.data
+                box = CANVAS_BOX
+            # Fading is done as part of compositing. Without a fade, only the
+            # layer's region is touched.
+            with timed("composite"):
+                image = compositor().composite(
+                    image, layer, offset, alpha_multiplier
+                )
+            self.store_image(image)
+        image.load()
+        self.record_change(box)
+        cache_image_on_commit((self.id, self.version), image)
+        return image
+
+    def store_image(self, image):
+        """Encode an image as the canvas data, with the configured codec."""
+        with timed("encode"):
+            self.data, self.data_format = encode_canvas(image)
+
+    def cached_image(self):
+        """Return the decoded image for this version if cached, or None.
+
+        The image is shared, so callers must not modify it.
+        """
+        return image_cache.get((self.id, self.version))
+
+    def pending_fades(self, now=None):
+        """Return the number of fade periods not yet applied to the data."""
+        if not self.last_fade:
+            return 0
+        elapsed = (now or datetime.utcnow()) - self.last_fade
+        return max(0, math.floor(elapsed / FADE_PERIOD))
+
+    def next_fade(self, now=None):
+        """Return when the canvas next fades, or None if it never will."""
+        if not self.last_fade:
+            return None
+        return self.last_fade + (self.pending_fades(now) + 1) * FADE_PERIOD
+
+    def fade_level(self, now=None):
+        """Return a number that increases each time the canvas fades."""
+        if not self.last_fade:
+            return 0
+        applied = (self.last_fade - FADE_EPOCH) // FADE_PERIOD
+        return applied + self.pending_fades(now)
+
+    def faded_data(self, now=None):
+        """Return the canvas data as it should look now."""
+        return self.faded("data", now)
+
+    def faded_thumbnail(self, now=None):
+        """Return the thumbnail as it should look now."""
+        return self.faded("thumbnail", now)
+
+    def faded(self, attribute, now=None):
+        """Return a blob attribute as PNG, with pending fades applied.
+
+        Data stored in other formats is transcoded, and cached like faded
+        data is. The blob is only loaded if it isn't cached.
+        """
+        if attribute == "data":
+            stored = self.last_fade
+            data_format = self.data_format
+        else:
+            stored = self.thumbnail_hash
+            # Thumbnails are always stored as PNG.
+            data_format = None
+        if not stored:
+            return None
+        num_periods = self.pending_fades(now)
+        if not num_periods and is_wire_format(data_format):
+            return getattr(self, attribute)
+        return faded_cache.get_or_create(
+            self.faded_key(attribute, now),
+            lambda: fade(
+                getattr(self, attribute),
+                FADE_MULTIPLIER ** num_periods,
+                data_format,
+            ),
+        )
+
+    def faded_key(self, attribute, now=None):
+        """Return the faded cache key for a blob attribute."""
+        if attribute == "thumbnail":
+            return (self.id, attribute, self.thumbnail_key(now))
+        return (self.id, attribute, self.version, self.fade_level(now))
+
+    def thumbnail_key(self, now=None):
+        """Return a string that changes whenever the faded thumbnail changes.
+
+        This is derived from the stored thumbnail's hash and the number of
+        pending fades, so it doesn't require loading the thumbnail.
+        """
+        if not self.thumbnail_hash:
+            return None
+        num_periods = self.pending_fades(now)
+        if not num_periods:
+            return self.thumbnail_hash
+        return f"{self.thumbnail_hash}-{num_periods}"
+
+    def record_change(self, box):
+        """Bump the version, remembering which region changed."""
+        self.version, self.changes = next_change(
+            self.version, self.changes, box
+        )
+
+    def changed_region(self, version, fade_level=None, now=None, id=None):
+        """Return the box that changed after the given version, or None.
+
+        Returns the whole canvas if it has faded since the given fade level, if
+        the given ID is for another canvas (versions are per canvas, so they
+        start over when friends unfriend and friend again), or if the change
+        history is too short to tell.
+        """
+        if id is not None and id != self.id:
+            return CANVAS_BOX
+        if fade_level is not None and fade_level != self.fade_level(now):
+            return CANVAS_BOX
+        current = self.version or 0
+        if version == current:
+            return None
+        changes = self.changes or []
+        if version > current or not changes or changes[0][0] > version + 1:
+            return CANVAS_BOX
+        boxes = [change[1:] for change in changes if change[0] > version]
+        return (
+            min(box[0] for box in boxes),
+            min(box[1] for box in boxes),
+            max(box[2] for box in boxes),
+            max(box[3] for box in boxes),
+        )
+
+    def render_region(self, box, now=None):
+        """Return the faded canvas data cropped to the given box."""
+        image = None if self.pending_fades(now) else self.cached_image()
+        if image:
+            return encode_image(image.crop(box))
+        data = self.faded_data(now)
+        if box == CANVAS_BOX:
+            return data
+        image = decode_canvas(data, WIRE_FORMAT)
+        return encode_image(image.crop(box))
 
     def __repr__(self):
         return f"<Canvas {self.id}>"
+
+
+def friendship_state(friendship, canvas, now=None):
+    """Return cheap state that changes whenever a friendship's data changes."""
+    return (
+        friendship.friender_id,
+        friendship.friendee_id,
+        friendship.ignored,
+        friendship.updated_at,
+        canvas and canvas.thumbnail_key(now),
+    )
+
+
+def next_change(version, changes, box):
+    """Return a canvas's version and changes after a change to the box."""
+    version = (version or 0) + 1
+    changes = (changes or []) + [[version, *box]]
+    return version, changes[-MAX_CANVAS_CHANGES:]
+
+
+def crop_visible(layer, box):
+    """Crop a layer placed at a box down to its visible pixels.
+
+    Returns the cropped layer and its box, or (None, None) if nothing is
+    visible. Layers without an alpha channel are returned as they are.
+    """
+    if "A" not in layer.getbands():
+        return layer, box
+    visible = layer.getchannel("A").getbbox()
+    if not visible:
+        return None, None
+    if visible == (0, 0, *layer.size):
+        return layer, box
+    left, upper = box[:2]
+    cropped_box = (
+        left + visible[0],
+        upper + visible[1],
+        left + visible[2],
+        upper + visible[3],
+    )
+    return layer.crop(visible), cropped_box
+
+
+def contains(outer, inner):
+    """Return true if the inner box lies within the outer box."""
+    left, upper, right, lower = outer
+    if not left <= inner[0] <= inner[2] <= right:
+        return False
+    return upper <= inner[1] <= inner[3] <= lower
+
+
+def fade(data, alpha_multiplier, data_format=None):
+    """Fade stored image data by multiplying its alpha channel.
+
+    Returns PNG data, whatever format the data was stored in.
+    """
+    with timed("fade"):
+        image = decode_canvas(data, data_format)
+        if alpha_multiplier != 1:
+            image = compositor().fade(image, alpha_multiplier)
+        return encode_image(image)
+
+
+def compositor():
+    """Return the configured canvas compositor."""
+    return get_compositor(current_app.config["CANVAS_COMPOSITOR"])
+
+
+def render_thumbnail(image):
+    """Render an encoded thumbnail of a canvas image."""
+    from PIL import Image
+
+    with timed("thumbnail"):
+        thumbnail = image.copy()
+        thumbnail.thumbnail(THUMBNAIL_SIZE, Image.BICUBIC)
+        return encode_image(thumbnail)
+
+
+def encode_image(image):
+    """Encode an image in the format sent to clients."""
+    return get_codec(WIRE_FORMAT).encode(image)
+
+
+def encode_canvas(image):
+    """Encode canvas data with the configured codec.
+
+    Returns (data, format), where format is the codec name to store with it.
+    """
+    name = current_app.config["CANVAS_CODEC"]
+    level = current_app.config["CANVAS_CODEC_LEVEL"]
+    return get_codec(name).encode(image, level), name
+
+
+def decode_canvas(data, data_format=None):
+    """Decode canvas data stored in the given format."""
+    return get_codec(data_format or WIRE_FORMAT).decode(data)
+
+
+def is_wire_format(data_format):
+    """Return true if data stored in a format can be sent to clients as is."""
+    return (data_format or WIRE_FORMAT) == WIRE_FORMAT
@@ -0,0 +1,236 @@
+"""This module notifies waiting requests when friends or canvases change.
+
+Views call notify() before committing a change. Requests can then long-poll
+with wait_for_change(), which returns as soon as a relevant change commits.
+With the "memory" backend, notifications only reach requests in the same
+process. With the "postgres" backend, they go through LISTEN/NOTIFY, so they
+reach every process.
+
+Waiting on a request thread would tie the thread up, so mira.server doesn't
+let waitress threads wait, and parks long-polls on its wait listener instead
+(see mira.waits). Other servers, like flask run, wait on request threads.
+Either way, only NOTIFY_MAX_WAITERS requests per process wait at once, and the
+rest respond right away, leaving the client to poll.
+"""
+
+from select import select
+from threading import BoundedSemaphore, Condition, Thread
+from time import monotonic, sleep
+import os
+
+from flask import current_app, request
+from sqlalchemy import event, text
+
+from mira.extensions import db
+from mira.request import make_etag
+
+
+CHANNEL = "mira_changes"
+
+
+class Broker:
+    """In-process publish/subscribe for change notifications.
+
+    Each topic has a counter that increases on every publish. Waiters record
+    the counter first, then wait for it to change, so they never miss a change
+    that happens in between.
+    """
+
+    def __init__(self, max_waiters):
+        self.counters = {}
+        self.condition = Condition()
+        self.waiters = BoundedSemaphore(max_waiters)
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """Call a function with the topic whenever anything is published.
+
+        Callbacks run while holding the broker's lock, so they must be quick.
+        """
+        self.subscribers.append(callback)
+
+    def token(self, topic):
+        """Return the current counter for a topic."""
+        with self.condition:
+            return self.counters.get(topic, 0)
+
+    def publish(self, topic):
+        """Wake everyone waiting on a topic."""
+        with self.condition:
+            self.counters[topic] = self.counters.get(topic, 0) + 1
+            # Run subscribers first, so woken waiters don't see stale caches.
+            for callback in self.subscribers:
+                callback(topic)
+            self.condition.notify_all()
+
+    def unless_changed(self, topic, token, function):
+        """Call a function unless the topic has changed from the token.
+
+        This is atomic with respect to publishing, so subscribers always see
+        (and can undo) anything the function does.
+        """
+        with self.condition:
+            if self.counters.get(topic, 0) == token:
+                function()
+
+    def limit_waiters(self, max_waiters):
+        """Change how many threads may wait at once (0 for none)."""
+        self.waiters = BoundedSemaphore(max_waiters)
+
+    def wait(self, topic, token, timeout):
+        """Wait until the topic changes from the token or the timeout passes.
+
+        This blocks the calling thread, so only a limited number of requests
+        can wait at once. The rest return right away, and clients fall back
+        to polling. Returns true if the topic changed.
+        """
+        if not self.waiters.acquire(blocking=False):
+            return False
+        try:
+            deadline = monotonic() + timeout
+            with self.condition:
+                while self.counters.get(topic, 0) == token:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+        finally:
+            self.waiters.release()
+
+
+class PostgresListener:
+    """Thread that relays Postgres notifications to the local broker."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.pid = None
+
+    def start(self, app):
+        """Start listening on an app's database, unless already listening."""
+        # Threads don't survive a fork, so check the process too.
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            Thread(target=self.run, args=(app,), daemon=True).start()
+
+    def run(self, app):
+        while True:
+            try:
+                with app.app_context():
+                    self.listen()
+            except Exception:
+                app.logger.exception("Lost connection for notifications")
+                sleep(1)
+
+    def listen(self):
+        connection = db.engine.raw_connection()
+        try:
+            connection.detach()
+            connection.connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute(f"LISTEN {CHANNEL}")
+            while True:
+                select([connection.connection], [], [], 60)
+                connection.connection.poll()
+                notifies = connection.connection.notifies
+                while notifies:
+                    self.broker.publish(notifies.pop(0).payload)
+        finally:
+            connection.close()
+
+
+def friends_topic(user_id):
+    """Return the topic for changes to a user's friends."""
+    return f"friends:{user_id}"
+
+
+def canvas_topic(canvas_id):
+    """Return the topic for changes to a canvas."""
+    return f"canvas:{canvas_id}"
+
+
+def login_topic(login_id):
+    """Return the topic for revoking a login ID."""
+    return f"login:{login_id}"
+
+
+def listen():
+    """Make sure this process hears about changes in other processes."""
+    if cross_process():
+        listener.start(current_app._get_current_object())
+
+
+def notify(*topics):
+    """Notify waiters of changes once the current transaction commits."""
+    if cross_process():
+        for topic in topics:
+            db.session.execute(
+                text("SELECT pg_notify(:channel, :topic)"),
+                {"channel": CHANNEL, "topic": topic},
+            )
+    # Publish in this process right after the commit too, rather than when
+    # the listener hears back, so its own next request sees the change.
+    db.session.info.setdefault("topics", set()).update(topics)
+
+
+def wait_for_change(topic, get_state):
+    """Get the state behind an ETag, waiting for it to change if asked.
+
+    If the request has a wait parameter (in seconds) and the client's ETag
+    still matches, this long-polls until a change to the topic commits. On
+    mira.waits's listener, the request is parked there instead, and this
+    returns right away.
+    """
+    max_wait = current_app.config["NOTIFY_MAX_WAIT_SECONDS"]
+    wait = min(request.args.get("wait", 0, type=float), max_wait)
+    if wait > 0:
+        listen()
+    token = broker.token(topic)
+    state = get_state()
+    if wait <= 0 or not request.if_none_match.contains(make_etag(state)):
+        return state
+    if "mira.wait" in request.environ:
+        parked = request.environ["mira.wait"]
+        if parked:
+            parked.park(topic, token, wait)
+        return state
+    # Don't hold a transaction (or a pooled connection) open while waiting.
+    # This also expires loaded objects, so get_state sees fresh data.
+    db.session.commit()
+    broker.wait(topic, token, wait)
+    # Check again even on timeout, in case the change happened in another
+    # process that this one can't hear from.
+    return get_state()
+
+
+@event.listens_for(db.session, "after_commit")
+def publish_committed(session):
+    for topic in session.info.pop("topics", ()):
+        broker.publish(topic)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_rolled_back(session):
+    session.info.pop("topics", None)
+
+
+def cross_process():
+    """Return true if notifications reach every process.
+
+    Caches that rely on notifications to evict stale entries are only safe if
+    they do.
+    """
+    return current_app.config["NOTIFY_BACKEND"] == "postgres"
+
+
+def init_app(app):
+    """Check an app's notification backend, and limit waiters to match."""
+    backend = app.config["NOTIFY_BACKEND"]
+    if backend not in ("memory", "postgres"):
+        raise ValueError(f"Unsupported notification backend: {backend}")
+    broker.limit_waiters(app.config["NOTIFY_MAX_WAITERS"])
+
+
+# The app sets the number of waiters.
+broker = Broker(0)
+listener = PostgresListener(broker)
@@ -0,0 +1,83 @@
+"""This module hashes passwords in a pool of worker processes.
+
+Hashing is deliberately slow and holds the GIL, so doing it on request threads
+would stall every other request during a burst of logins. Only a limited
+number of hashes can be pending at once, and the rest fail right away with
+ServerBusy so that clients can retry later.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+import os
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from mira.errors import ServerBusy
+
+
+class PasswordHasher:
+    """Pool of processes for hashing and checking passwords.
+
+    The method is a werkzeug hash method such as "pbkdf2:sha256:150000". With
+    no workers, hashing happens right away on the calling thread.
+    """
+
+    def __init__(self, method=None, workers=0, max_pending=1):
+        self.method = method
+        self.workers = workers
+        self.pending = BoundedSemaphore(max_pending)
+        self.lock = Lock()
+        self.executor = None
+        self.pid = None
+
+    def init_app(self, app):
+        """Hash with an app's settings."""
+        self.method = app.config["PASSWORD_HASH_METHOD"]
+        self.workers = app.config["PASSWORD_HASH_WORKERS"]
+        self.pending = BoundedSemaphore(app.config["PASSWORD_HASH_MAX_PENDING"])
+
+    def hash(self, password):
+        """Return a salted hash of a password."""
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, pw_hash, password):
+        """Check a password against a hash."""
+        return self.run(check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Return true if a hash was made with different cost parameters."""
+        return pw_hash.split("$", 1)[0] != self.method
+
+    def run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        if not self.pending.acquire(blocking=False):
+            raise ServerBusy("Too many password checks in progress")
+        try:
+            return self.get_executor().submit(function, *args).result()
+        except BrokenProcessPool:
+            # Start a new pool next time, in case a worker was killed.
+            with self.lock:
+                self.executor = None
+            raise
+        finally:
+            self.pending.release()
+
+    def get_executor(self):
+        # Fork workers from a clean server process, since forking a process
+        # with threads is unsafe. Start them again after the server forks.
+        with self.lock:
+            if not self.executor or self.pid != os.getpid():
+                self.pid = os.getpid()
+                context = get_context("forkserver")
+                context.set_forkserver_preload(["werkzeug.security"])
+                self.executor = ProcessPoolExecutor(
+                    self.workers, mp_context=context
+                )
+            return self.executor
+
+
+hasher = PasswordHasher()
+init_app = hasher.init_app
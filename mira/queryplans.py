@@ -0,0 +1,165 @@
+"""This module checks the plans Postgres picks for the queries views make.
+
+Run it against a database with users, friendships, and canvases in it (such
+as the one './run.sh load' leaves behind):
+
+    flask explain-queries [--check] [--verbose]
+
+Each query runs under EXPLAIN (ANALYZE, BUFFERS) in a transaction that is
+rolled back, and sequential scans are flagged. On a small database Postgres
+may prefer a sequential scan even when an index fits, so --check disables
+them first. Any that remain mean no index fits the query, and the command
+fails.
+"""
+
+from contextlib import contextmanager
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event
+
+from mira.extensions import db
+from mira.models import Canvas, Friendship, User
+
+
+# The queries views make for each request, as functions of a user, one of
+# their friends, and the ID of the canvas they share.
+QUERIES = {
+    "login": lambda user, friend, canvas_id: User.query.filter_by(
+        login_id=user.login_id
+    ).first(),
+    "by_name": lambda user, friend, canvas_id: User.by_name(friend.username),
+    "relation": lambda user, friend, canvas_id: user.relation(
+        friend.username, canvas=True
+    ),
+    "shared_canvas": lambda user, friend, canvas_id: user.shared_canvas(
+        friend.username
+    ),
+    "canvas": lambda user, friend, canvas_id: Canvas.query.get(canvas_id),
+    "canvas_friendships": lambda user, friend, canvas_id: (
+        Friendship.query.filter_by(canvas_id=canvas_id).all()
+    ),
+    "outgoing_friendships": lambda user, friend, canvas_id: (
+        user.outgoing_friendships.all()
+    ),
+    "incoming_friendships": lambda user, friend, canvas_id: (
+        user.incoming_friendships.all()
+    ),
+    "friendships_with_canvases": lambda user, friend, canvas_id: (
+        user.friendships_with_canvases().all()
+    ),
+    "friends_lists": lambda user, friend, canvas_id: user.friends_lists(),
+    "involved_user_ids": lambda user, friend, canvas_id: (
+        user.involved_user_ids()
+    ),
+}
+
+
+def init_app(app):
+    """Add the explain-queries command to an app."""
+    app.cli.add_command(explain_queries_command)
+
+
+@click.command("explain-queries")
+@click.option(
+    "--check",
+    is_flag=True,
+    help="Fail if a query scans a whole table even with indexes preferred.",
+)
+@click.option("--verbose", is_flag=True, help="Print each query plan.")
+@with_appcontext
+def explain_queries_command(check, verbose):
+    """Explain the queries views make and flag sequential scans."""
+    if db.engine.dialect.name != "postgresql":
+        raise click.ClickException("Query plans need a Postgres database")
+    sample = (
+        Friendship.query.filter(Friendship.canvas_id.isnot(None))
+        .order_by(Friendship.friender_id, Friendship.friendee_id)
+        .first()
+    )
+    if not sample:
+        raise click.ClickException(
+            "Seed the database with friends first (e.g. './run.sh load')"
+        )
+    ids = sample.friender_id, sample.friendee_id, sample.canvas_id
+    failed = []
+    try:
+        if check:
+            db.session.execute("SET LOCAL enable_seqscan = off")
+        for name, query in QUERIES.items():
+            scans = explain_query(name, query, *ids, verbose)
+            if scans:
+                failed.append(name)
+    finally:
+        db.session.rollback()
+    if failed and check:
+        raise click.ClickException(
+            f"Sequential scans in {', '.join(failed)}; add an index"
+        )
+
+
+def explain_query(name, query, user_id, friend_id, canvas_id, verbose):
+    """Explain the statements a query makes, and return tables it scans."""
+    # Start each query with nothing loaded, so it isn't skipped.
+    db.session.expunge_all()
+    user = User.query.get(user_id)
+    friend = User.query.get(friend_id)
+    with captured_statements() as statements:
+        query(user, friend, canvas_id)
+    cursor = db.session.connection().connection.cursor()
+    scanned = []
+    for statement, parameters in statements:
+        cursor.execute(
+            "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters
+        )
+        result = cursor.fetchone()[0][0]
+        plan = result["Plan"]
+        buffers = plan["Shared Hit Blocks"] + plan["Shared Read Blocks"]
+        scans = list(sequential_scans(plan))
+        click.echo(
+            f"{name}: {result['Execution Time']:.2f} ms, {buffers} buffers"
+        )
+        for table in scans:
+            click.secho(f"  Seq Scan on {table}", fg="red")
+        if verbose:
+            click.echo(statement)
+            for line in describe(plan):
+                click.echo(line)
+        scanned.extend(scans)
+    return scanned
+
+
+@contextmanager
+def captured_statements():
+    """Collect the SELECT statements executed, along with their parameters."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, many):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+
+
+def sequential_scans(plan):
+    """Yield the tables a plan reads in full."""
+    if plan["Node Type"] == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from sequential_scans(child)
+
+
+def describe(plan, depth=1):
+    """Yield an indented line for each node in a plan."""
+    line = plan["Node Type"]
+    if "Index Name" in plan:
+        line += f" using {plan['Index Name']}"
+    if "Relation Name" in plan:
+        line += f" on {plan['Relation Name']}"
+    yield "  " * depth + f"{line} (rows={plan['Actual Rows']})"
+    for child in plan.get("Plans", []):
+        yield from describe(child, depth + 1)
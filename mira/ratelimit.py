@@ -0,0 +1,183 @@
+"""This module stores rate limits in SQL, so they're shared across processes.
+
+Setting RATELIMIT_STORAGE_URL to a sqlite:// URL shares limits between the
+processes on one machine through a local file. A postgresql:// URL shares them
+between machines. Each hit is a single atomic upsert. When the URL is the
+app's own database, limits share the app's connection pool.
+
+Limits use a sliding window counter: the count for the current fixed window
+plus a share of the previous window's count, weighted by how much of the
+previous window still overlaps the sliding window. This smooths out bursts at
+window boundaries while storing just two numbers per key.
+"""
+
+from time import time
+import itertools
+import os
+
+from flask import current_app
+from limits.storage import Storage
+from sqlalchemy import Column, Integer, String, Table, create_engine, text
+
+from mira.extensions import db
+
+
+# Delete expired rows after this many hits in each process.
+CLEANUP_INTERVAL = 1000
+
+rate_limits = Table(
+    "rate_limits",
+    db.metadata,
+    Column("key", String, primary_key=True),
+    Column("window_start", Integer, nullable=False),
+    Column("expiry", Integer, nullable=False),
+    Column("count", Integer, nullable=False),
+    Column("previous", Integer, nullable=False),
+)
+
+INCREMENT = """
+INSERT INTO rate_limits (key, window_start, expiry, count, previous)
+VALUES (:key, :window_start, :expiry, 1, 0)
+ON CONFLICT (key) DO UPDATE SET
+    previous = CASE
+        WHEN rate_limits.window_start = excluded.window_start
+        THEN rate_limits.previous
+        WHEN rate_limits.window_start = excluded.window_start - excluded.expiry
+        THEN rate_limits.count
+        ELSE 0
+    END,
+    count = CASE
+        WHEN rate_limits.window_start = excluded.window_start
+        THEN rate_limits.count + 1
+        ELSE 1
+    END,
+    window_start = excluded.window_start,
+    expiry = excluded.expiry
+"""
+
+INCREMENT_RETURNING = (
+    INCREMENT + "RETURNING window_start, expiry, count, previous"
+)
+
+SELECT = """
+SELECT window_start, expiry, count, previous FROM rate_limits WHERE key = :key
+"""
+
+CLEANUP = "DELETE FROM rate_limits WHERE window_start + 2 * expiry < :now"
+
+
+class SQLStorage(Storage):
+    """Rate limit storage in a SQLite or Postgres table.
+
+    This only supports the fixed window strategy (the default), which it turns
+    into a sliding window.
+    """
+
+    STORAGE_SCHEME = ["sqlite", "postgres", "postgresql"]
+
+    def __init__(self, uri, **options):
+        super().__init__(uri, **options)
+        self.uri = uri
+        self.options = options
+        self.hits = itertools.count(1)
+        self.engine = None
+        self.pid = None
+
+    def get_engine(self):
+        # Connections can't be shared with forked processes.
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.engine = self.create_engine()
+                rate_limits.create(self.engine, checkfirst=True)
+            return self.engine
+
+    def create_engine(self):
+        """Return the app's engine for its own database, or a new one.
+
+        New engines get the app's pool settings and statement timeout.
+        """
+        config = current_app.config
+        if self.uri == config["SQLALCHEMY_DATABASE_URI"]:
+            return db.engine
+        options = config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        if not self.uri.startswith("postgres"):
+            options = {}
+        return create_engine(self.uri, **{**options, **self.options})
+
+    def incr(self, key, expiry, elastic_expiry=False):
+        """Count a hit and return the weighted count for the sliding window."""
+        now = time()
+        params = {
+            "key": key,
+            "window_start": int(now // expiry * expiry),
+            "expiry": expiry,
+        }
+        engine = self.get_engine()
+        with engine.begin() as connection:
+            if engine.dialect.name == "postgresql":
+                # Postgres can do it in one round trip.
+                row = connection.execute(
+                    text(INCREMENT_RETURNING), params
+                ).first()
+            else:
+                connection.execute(text(INCREMENT), params)
+                row = connection.execute(text(SELECT), params).first()
+        if next(self.hits) % CLEANUP_INTERVAL == 0:
+            self.cleanup(now)
+        return weighted_count(row, now)
+
+    def get(self, key):
+        """Return the weighted count for the sliding window."""
+        with self.get_engine().connect() as connection:
+            row = connection.execute(text(SELECT), {"key": key}).first()
+        return weighted_count(row, time())
+
+    def get_expiry(self, key):
+        """Return when the current fixed window ends."""
+        with self.get_engine().connect() as connection:
+            row = connection.execute(text(SELECT), {"key": key}).first()
+        if not row:
+            return int(time())
+        return row.window_start + row.expiry
+
+    def check(self):
+        """Return true if the database is reachable."""
+        try:
+            with self.get_engine().connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+
+    def cleanup(self, now):
+        """Delete rows that no longer affect any limit."""
+        with self.get_engine().begin() as connection:
+            connection.execute(text(CLEANUP), {"now": now})
+
+    def reset(self):
+        """Clear all rate limits."""
+        with self.get_engine().begin() as connection:
+            return connection.execute(rate_limits.delete()).rowcount
+
+    def clear(self, key):
+        """Clear the rate limit for a key."""
+        with self.get_engine().begin() as connection:
+            connection.execute(
+                rate_limits.delete().where(rate_limits.c.key == key)
+            )
+
+
+def weighted_count(row, now):
+    """Return the sliding window count from a row, as of a given time."""
+    if not row:
+        return 0
+    window_start = int(now // row.expiry * row.expiry)
+    if row.window_start == window_start:
+        count, previous = row.count, row.previous
+    elif row.window_start == window_start - row.expiry:
+        count, previous = 0, row.count
+    else:
+        return 0
+    overlap = 1 - (now - window_start) / row.expiry
+    return count + int(previous * overlap)
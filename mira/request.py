@@ -1,6 +1,12 @@
 """This module provides helper functions for servicing requests."""
 
-from flask import Request, abort, jsonify, request
+from hashlib import sha1
+
+from flask import Request, Response, abort, jsonify, request
+
+
+# Content types accepted and served as raw binary instead of JSON.
+BINARY_MIMETYPES = ["image/png", "application/octet-stream"]
 
 
 def ok(code, message, **kwargs):
@@ -13,6 +19,42 @@ def error(status, code, message, **kwargs):
     return jsonify(code=code, message=message, **kwargs), status
 
 
+def binary(data, status=200, headers=None):
+    """Create a raw binary response in the client's preferred content type."""
+    mimetype = request.accept_mimetypes.best_match(BINARY_MIMETYPES)
+    return Response(
+        data,
+        status=status,
+        headers=headers,
+        mimetype=mimetype or BINARY_MIMETYPES[0],
+    )
+
+
+def conditional(state, build):
+    """Build a response tagged with an ETag, or return 304 Not Modified.
+
+    The ETag is a hash of the given state, which should be cheap to get (row
+    versions, timestamps, and so on). If the client already has that ETag,
+    build is never called, so the body is never serialized and blobs it needs
+    are never loaded.
+    """
+    etag = make_etag(state)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    # Let clients store responses, but make them revalidate every time.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def make_etag(state):
+    """Make an ETag from a representation of some state."""
+    return sha1(repr(state).encode()).hexdigest()
+
+
 def abort_json(status, code, message, **kwargs):
     """Abort with a JSON error response."""
     response = jsonify(code=code, message=message, **kwargs)
@@ -61,3 +103,16 @@ def get_fields(*fields):
     if len(fields) == 1:
         return json[fields[0]]
     return [str(json[f]) for f in fields]
+
+
+def is_binary():
+    """Return true if the request body is raw binary data."""
+    return request.mimetype in BINARY_MIMETYPES
+
+
+def wants_binary():
+    """Return true if the client prefers a raw binary response over JSON."""
+    best = request.accept_mimetypes.best_match(
+        ["application/json"] + BINARY_MIMETYPES
+    )
+    return best in BINARY_MIMETYPES
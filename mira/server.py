@@ -0,0 +1,201 @@
+"""This module serves the app from several pre-forked waitress processes.
+
+The app is loaded once, before forking, so workers start quickly and share
+memory for code. Each worker has its own GIL, so CPU-bound work like canvas
+mixing doesn't serialize across the whole server. Run it with:
+
+    python3 -m mira.server --port 8080
+
+Waitress threads don't wait for changes. To serve long-polls, pass
+--wait-port, and each worker serves them on that port from an event loop
+(see mira.waits).
+
+To report metrics for all workers together, set the prometheus_multiproc_dir
+environment variable to an existing directory that only this server uses.
+
+Workers share notifications and rate limits through the database, so running
+more than one needs Postgres (see process_config in mira.config). The server
+refuses to start several workers with per-process state.
+
+Templates and Pillow are loaded before forking, and each worker opens its
+database connections before taking requests, so the first requests don't wait
+on them. The log reports how long each step of starting up took.
+"""
+
+from argparse import ArgumentParser
+from glob import glob
+from time import perf_counter, sleep
+import logging
+import os
+import signal
+import socket
+
+from jinja2 import TemplateNotFound
+from prometheus_client import multiprocess
+from waitress import serve
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--wait-port", type=int, help="Port to serve long-polls on"
+    )
+    args = parser.parse_args()
+    # Import the app here, not at the top. The password hashing pool's
+    # forkserver imports this module again in each hashing process, which
+    # should stay small.
+    from mira import create_app, startup_seconds
+    from mira.notifications import broker
+
+    app = create_app()
+    app.logger.setLevel(logging.INFO)
+    workers = app.config["SERVER_WORKERS"]
+    if workers > 1:
+        check_shared_state(app)
+    start = perf_counter()
+    warm_templates(app)
+    startup_seconds["templates"] = perf_counter() - start
+    start = perf_counter()
+    warm_codec(app)
+    startup_seconds["codec"] = perf_counter() - start
+    steps = ", ".join(f"{k} {v:.3f}s" for k, v in startup_seconds.items())
+    total = sum(startup_seconds.values())
+    app.logger.info(f"Loaded the app in {total:.2f}s ({steps})")
+    listener = listen(args.host, args.port)
+    wait_listener = args.wait_port and listen(args.host, args.wait_port)
+    # Only the wait listener's event loop holds requests open.
+    broker.limit_waiters(0)
+    metrics_dir = os.getenv("prometheus_multiproc_dir")
+    if metrics_dir:
+        # Start from zero, rather than adding to the last run's metrics.
+        for path in glob(os.path.join(metrics_dir, "*.db")):
+            os.remove(path)
+    else:
+        app.logger.warning("Metrics are per worker without a metrics dir")
+    supervise(app, listener, wait_listener, workers, metrics_dir)
+
+
+def listen(host, port):
+    """Open a listening socket to share with the workers."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+    return listener
+
+
+def check_shared_state(app):
+    """Exit unless the config shares state between workers."""
+    problems = []
+    if app.config["NOTIFY_BACKEND"] != "postgres":
+        problems.append("NOTIFY_BACKEND is not postgres")
+    storage = app.config["RATELIMIT_STORAGE_URL"]
+    if app.config["RATELIMIT_ENABLED"] and storage.startswith("memory"):
+        problems.append("RATELIMIT_STORAGE_URL is not a SQL database")
+    if problems:
+        raise SystemExit(
+            f"Can't run {app.config['SERVER_WORKERS']} workers, since "
+            f"{' and '.join(problems)} (set FLASK_SERVER_WORKERS=1 or use a "
+            "Postgres DATABASE_URL)"
+        )
+
+
+def supervise(app, listener, wait_listener, workers, metrics_dir=None):
+    """Keep the given number of workers running until told to stop."""
+    children = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    app.logger.info(f"Starting {workers} workers")
+    while True:
+        while not stopping and len(children) < workers:
+            children.add(fork_worker(app, listener, wait_listener))
+        if not children:
+            return
+        pid, status = os.wait()
+        children.discard(pid)
+        if metrics_dir:
+            multiprocess.mark_process_dead(pid)
+        if not stopping:
+            app.logger.error(f"Worker {pid} exited with status {status}")
+            # Don't restart in a tight loop if workers crash on startup.
+            sleep(1)
+
+
+def fork_worker(app, listener, wait_listener=None):
+    """Start a worker process and return its PID."""
+    from mira.extensions import db
+    from mira.waits import serve_waits
+
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Don't share the parent's database connections.
+        db.get_engine(app).dispose()
+        start = perf_counter()
+        warm_db_pool(app, db)
+        app.logger.info(
+            f"Worker {os.getpid()} connected in {perf_counter() - start:.3f}s"
+        )
+        if wait_listener:
+            serve_waits(app, wait_listener)
+        serve(app, sockets=[listener], threads=app.config["SERVER_THREADS"])
+        status = 0
+    finally:
+        os._exit(status)
+
+
+def warm_templates(app):
+    """Compile the page template, so forked workers share it."""
+    try:
+        app.jinja_env.get_template("index.html")
+    except TemplateNotFound:
+        app.logger.warning("No dist/index.html (build the Vue app first)")
+
+
+def warm_codec(app):
+    """Exit unless the canvas codec works here, loading Pillow to check."""
+    from mira.codecs import check_codec
+
+    try:
+        check_codec(
+            app.config["CANVAS_CODEC"], app.config["CANVAS_CODEC_LEVEL"]
+        )
+    except ValueError as ex:
+        # Fail now, rather than on the first sync.
+        raise SystemExit(str(ex))
+
+
+def warm_db_pool(app, db):
+    """Fill the connection pool with as many connections as threads."""
+    from sqlalchemy.exc import SQLAlchemyError
+
+    connections = app.config["SERVER_THREADS"]
+    if "SQLALCHEMY_ENGINE_OPTIONS" in app.config:
+        connections = min(connections, app.config["DB_POOL_SIZE"])
+    try:
+        engine = db.get_engine(app)
+        opened = [engine.connect() for _ in range(connections)]
+    except SQLAlchemyError:
+        # Serve anyway, since the database may come back.
+        app.logger.exception("Failed to connect to the database")
+        return
+    for connection in opened:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
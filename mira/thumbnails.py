@@ -0,0 +1,133 @@
+"""This module renders canvas thumbnails in the background."""
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from threading import Condition, Thread
+from time import monotonic
+import os
+
+from sqlalchemy import or_
+
+from mira.extensions import db
+from mira.metrics import THUMBNAIL_QUEUE_DEPTH
+from mira.models import Canvas, Friendship, render_thumbnail
+from mira.notifications import friends_topic, notify
+
+
+class ThumbnailPipeline:
+    """Pipeline stage that renders thumbnails off the request path.
+
+    Updates to the same canvas are coalesced, so only the latest image gets
+    rendered. Rendering waits until the canvas has been quiet for the debounce
+    period, or until the maximum delay has passed. With no workers, thumbnails
+    are rendered right away on the calling thread.
+    """
+
+    def __init__(self, workers=0, debounce=0, max_delay=0):
+        self.app = None
+        self.workers = workers
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # Maps canvas IDs to [due, deadline, version, image] lists.
+        self.pending = {}
+        self.running = 0
+        self.condition = Condition()
+        self.executor = None
+        self.pid = None
+
+    def init_app(self, app):
+        """Render thumbnails with an app's settings, into its database."""
+        self.app = app
+        self.workers = app.config["THUMBNAIL_WORKERS"]
+        self.debounce = app.config["THUMBNAIL_DEBOUNCE_SECONDS"]
+        self.max_delay = app.config["THUMBNAIL_MAX_DELAY_SECONDS"]
+
+    def submit(self, canvas_id, version, image):
+        """Schedule a thumbnail render for a canvas image."""
+        if not self.workers:
+            store_thumbnail(canvas_id, version, render_thumbnail(image))
+            return
+        now = monotonic()
+        with self.condition:
+            self.start_locked()
+            entry = self.pending.get(canvas_id)
+            deadline = entry[1] if entry else now + self.max_delay
+            due = min(now + self.debounce, deadline)
+            self.pending[canvas_id] = [due, deadline, version, image]
+            self.record_depth_locked()
+            self.condition.notify()
+
+    def depth(self):
+        """Return the number of thumbnails waiting or being rendered."""
+        with self.condition:
+            return len(self.pending) + self.running
+
+    def record_depth_locked(self):
+        THUMBNAIL_QUEUE_DEPTH.set(len(self.pending) + self.running)
+
+    def start_locked(self):
+        # Start threads lazily, and again after forking, since threads don't
+        # survive a fork.
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.pending.clear()
+        self.running = 0
+        self.executor = ThreadPoolExecutor(self.workers)
+        Thread(target=self.schedule, daemon=True).start()
+
+    def schedule(self):
+        """Hand due thumbnails to the workers (runs on its own thread)."""
+        while True:
+            with self.condition:
+                now = monotonic()
+                due = [k for k, v in self.pending.items() if v[0] <= now]
+                if not due:
+                    wake = min((v[0] for v in self.pending.values()), default=0)
+                    self.condition.wait(wake - now if wake else None)
+                    continue
+                jobs = [(k, *self.pending.pop(k)[2:]) for k in due]
+                self.running += len(jobs)
+            for job in jobs:
+                self.executor.submit(self.render, *job)
+
+    def render(self, canvas_id, version, image):
+        """Render and store a thumbnail (runs on a worker thread)."""
+        try:
+            with self.app.app_context():
+                store_thumbnail(canvas_id, version, render_thumbnail(image))
+                db.session.remove()
+        except Exception:
+            self.app.logger.exception(f"Failed to render thumbnail {canvas_id}")
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.record_depth_locked()
+
+
+def store_thumbnail(canvas_id, version, thumbnail):
+    """Save a thumbnail unless one from a newer version is already stored."""
+    updated = Canvas.query.filter(
+        Canvas.id == canvas_id,
+        Canvas.version >= version,
+        or_(
+            Canvas.thumbnail_version.is_(None),
+            Canvas.thumbnail_version < version,
+        ),
+    ).update(
+        {
+            "thumbnail": thumbnail,
+            "thumbnail_version": version,
+            "thumbnail_hash": sha256(thumbnail).hexdigest()[:16],
+        },
+        synchronize_session=False,
+    )
+    if updated:
+        # Friend data includes the thumbnail, so let both friends know.
+        friendships = Friendship.query.filter_by(canvas_id=canvas_id)
+        notify(*(friends_topic(f.friender_id) for f in friendships))
+    db.session.commit()
+
+
+pipeline = ThumbnailPipeline()
+init_app = pipeline.init_app
@@ -1,19 +1,45 @@
 """This module defines views, including both web routes and API endpoints."""
 
 from base64 import b64decode, b64encode
+from datetime import datetime
 import binascii
 
-from flask import jsonify, request, render_template
+from flask import Blueprint, Response, current_app, jsonify, request
 from flask_login import current_user, login_user, logout_user, login_required
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload, undefer
 from werkzeug.exceptions import HTTPException, InternalServerError
 
-from mira import app
-from mira.errors import InvalidAttribute
+from mira.assets import render_index
+from mira.errors import InvalidAttribute, ServerBusy
 from mira.extensions import db, limiter, login_manager
+from mira.metrics import exposition, query_budget
 from mira.models import Canvas, Friendship, User
-from mira.request import error, get_fields, ok
+from mira.notifications import (
+    canvas_topic,
+    friends_topic,
+    notify,
+    wait_for_change,
+)
+from mira.thumbnails import pipeline as thumbnails
+from mira.request import (
+    abort_json,
+    binary,
+    conditional,
+    error,
+    get_fields,
+    get_json,
+    is_binary,
+    ok,
+    wants_binary,
+)
+
+
+blueprint = Blueprint("views", __name__)
+
+
+def init_app(app):
+    """Add the views to an app."""
+    app.register_blueprint(blueprint)
 
 
 # Rate limits for API endpoints.
@@ -26,7 +52,7 @@ username_limit = limiter.limit(
 logged_in_limit = limiter.limit("60/minute")
 
 
-@app.errorhandler(HTTPException)
+@blueprint.app_errorhandler(HTTPException)
 def handle_http_error(ex):
     # For a 500 Internal Server Error, Flask passes the original exception. We
     # don't want that as the exception message could have sensitive inforation.
@@ -36,47 +62,76 @@ def handle_http_error(ex):
     return error(ex.code, "error", ex.name)
 
 
-@app.route("/", defaults={"path": ""})
-@app.route("/<path:path>")
+@blueprint.app_errorhandler(ServerBusy)
+def handle_server_busy(ex):
+    response, status = error(503, "busy", ex.message)
+    response.headers["Retry-After"] = "1"
+    return response, status
+
+
+@blueprint.route("/metrics")
+@query_budget(0)
+def metrics():
+    token = current_app.config["METRICS_TOKEN"]
+    if not token and not current_app.debug:
+        # Don't show traffic and timings to anyone who asks.
+        return error(404, "metrics_disabled", "Metrics need a METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return error(401, "auth_fail", "Wrong metrics token")
+    data, content_type = exposition()
+    return Response(data, content_type=content_type)
+
+
+@blueprint.route("/", defaults={"path": ""})
+@blueprint.route("/<path:path>")
+@query_budget(1)
 def catch_all(path):
     username = current_user.username if current_user.is_authenticated else None
-    return render_template("index.html", username=username)
+    return render_index(username)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter_by(login_id=user_id).first()
+    # Only trust the cache for reads. Writes check the login ID is current.
+    return User.by_login_id(user_id, cached=request.method in ("GET", "HEAD"))
 
 
-@app.route("/api/check")
+@blueprint.route("/api/check")
 @login_required
 @logged_in_limit
+@query_budget(1)
 def check():
     return ok("logged_in", "You are logged in", username=current_user.username)
 
 
-@app.route("/api/login", methods=["POST"])
+@blueprint.route("/api/login", methods=["POST"])
 @public_limit
 @username_limit
+@query_budget(2)
 def login():
     username, password = get_fields("username", "password")
     user = User.by_name(username)
     if not user or not user.check_password(password):
         return error(401, "login_fail", "Wrong username or password")
+    if user.upgrade_password(password):
+        db.session.add(user)
+        db.session.commit()
     login_user(user, remember=True)
     assert current_user.is_authenticated
     return ok("login", "Logged in")
 
 
-@app.route("/api/logout", methods=["POST"])
+@blueprint.route("/api/logout", methods=["POST"])
 @login_required
+@query_budget(1)
 def logout():
     logout_user()
     return ok("logout", "Logged out")
 
 
-@app.route("/api/register", methods=["POST"])
+@blueprint.route("/api/register", methods=["POST"])
 @public_limit
+@query_budget(1)
 def register():
     username, password = get_fields("username", "password")
     try:
@@ -95,9 +150,10 @@ def register():
     return ok("register", "Registered account")
 
 
-@app.route("/api/change_password", methods=["PUT"])
+@blueprint.route("/api/change_password", methods=["PUT"])
 @login_required
 @logged_in_limit
+@query_budget(2)
 def change_password():
     password, new_password = get_fields("password", "new_password")
     user = current_user
@@ -111,48 +167,64 @@ def change_password():
     return ok("change", "Changed password and logged out")
 
 
-@app.route("/api/account", methods=["DELETE"])
+@blueprint.route("/api/account", methods=["DELETE"])
 @login_required
 @logged_in_limit
+@query_budget(5)
 def delete_user():
     password = get_fields("password")
     user = current_user
     if not user.check_password(password):
         return error(401, "auth_fail", "Wrong password")
-    db.session.delete(user)
+    notify(*(friends_topic(user_id) for user_id in user.involved_user_ids()))
+    user.revoke_login_id()
+    user.delete()
     db.session.commit()
     logout_user()
     return ok("delete", "Deleted account")
 
 
-@app.route("/api/friends/<username>")
+@blueprint.route("/api/friends/<username>")
 @login_required
 @logged_in_limit
+@query_budget(3)
 def get_friend(username):
-    user = User.by_name(username)
-    if not user:
+    relation = None
+
+    def friend_state():
+        # Resolve again each time, since the user could change while waiting.
+        nonlocal relation
+        relation = current_user.relation(username, canvas=True)
+        return relation and relation.state()
+
+    state = wait_for_change(friends_topic(current_user.id), friend_state)
+    if not state:
         return error(404, "unknown_user", "No user has that username")
-    return jsonify(current_user.friend_data(user))
+    return conditional(
+        state, lambda: jsonify(current_user.friend_data(relation))
+    )
 
 
-@app.route("/api/friends/<username>", methods=["PUT"])
+@blueprint.route("/api/friends/<username>", methods=["PUT"])
 @login_required
 @logged_in_limit
+@query_budget(6)
 def add_friend(username):
-    user = User.by_name(username)
-    if not user:
+    relation = current_user.relation(username)
+    if not relation:
         return error(404, "unknown_user", "No user has that username")
+    user = relation.user
     if user == current_user:
         return error(422, "self", "Self cannot be a friend")
-    friendship = Friendship.between(current_user, user)
-    reverse_friendship = Friendship.between(user, current_user)
+    friendship = relation.friendship
+    reverse_friendship = relation.reverse_friendship
     if friendship:
         if reverse_friendship:
             return ok("no_op_accept", "Already friends")
         if friendship.ignored:
             friendship.ignored = False
             db.session.add(friendship)
-            db.session.commit()
+            commit_friendship_change(current_user, user)
             return ok("request", "Sent friend request")
         return ok("no_op_request", "Already sent friend request")
     if not current_user.can_add_friend():
@@ -165,77 +237,96 @@ def add_friend(username):
         reverse_friendship.ignored = False
         db.session.add(reverse_friendship)
     db.session.add(friendship)
-    db.session.commit()
+    commit_friendship_change(current_user, user)
     if reverse_friendship:
         return ok("accept", "Accepted friend request")
     return ok("request", "Sent friend request")
 
 
-@app.route("/api/friends/<username>", methods=["DELETE"])
+@blueprint.route("/api/friends/<username>", methods=["DELETE"])
 @login_required
 @logged_in_limit
+@query_budget(8)
 def remove_friend(username):
-    user = User.by_name(username)
-    if not user:
+    relation = current_user.relation(username)
+    if not relation:
         return error(404, "unknown_user", "No user has that username")
+    user = relation.user
     if user == current_user:
         return error(422, "self", "Self cannot be a friend")
-    friendship = Friendship.between(current_user, user)
-    reverse_friendship = Friendship.between(user, current_user)
+    friendship = relation.friendship
+    reverse_friendship = relation.reverse_friendship
     if friendship and reverse_friendship:
         reverse_friendship.ignored = True
         db.session.add(reverse_friendship)
+        if friendship.canvas_id:
+            # Deleting the friendship also deletes the canvas.
+            notify(canvas_topic(friendship.canvas_id))
         db.session.delete(friendship)
-        db.session.commit()
+        commit_friendship_change(current_user, user)
         return ok("unfriend", "Unfriended user")
     if friendship and not reverse_friendship:
         db.session.delete(friendship)
-        db.session.commit()
+        commit_friendship_change(current_user, user)
         return ok("revoke", "Revoked friend request")
     if not friendship and reverse_friendship:
         if reverse_friendship.ignored:
             return ok("no_op_ignore", "Already ignored friend request")
         reverse_friendship.ignored = True
         db.session.add(reverse_friendship)
-        db.session.commit()
+        commit_friendship_change(current_user, user)
         return ok("ignore", "Ignored friend request")
     return ok("no_op_nothing", "Not friends with that user")
 
 
-@app.route("/api/friends")
+def commit_friendship_change(*users):
+    """Commit a change to friendships, notifying the users involved."""
+    notify(*(friends_topic(user.id) for user in users))
+    db.session.commit()
+
+
+@blueprint.route("/api/friends")
 @login_required
 @logged_in_limit
+@query_budget(6)
 def get_friends():
-    def serialize(users):
-        return [u.username for u in users]
-
-    return jsonify(
-        friends=serialize(current_user.friends()),
-        incoming_requests=serialize(current_user.incoming_friend_requests()),
-        outgoing_requests=serialize(current_user.outgoing_friend_requests()),
-    )
+    return friends_response("friends_lists")
 
 
-@app.route("/api/friends_data")
+@blueprint.route("/api/friends_data")
 @login_required
 @logged_in_limit
+@query_budget(10)
 def get_friends_data():
-    return jsonify(current_user.all_friends_data())
+    return friends_response("all_friends_data")
+
 
+def friends_response(view):
+    """Respond with a friends view for the current user, from the cache."""
+    data = None
 
-@app.route("/api/friends/<username>/canvas")
+    def friends_state():
+        nonlocal data
+        state, data = current_user.friends_view(view)
+        return state
+
+    return conditional(
+        wait_for_change(friends_topic(current_user.id), friends_state),
+        lambda: jsonify(data),
+    )
+
+
+@blueprint.route("/api/friends/<username>/canvas")
 @login_required
 @logged_in_limit
+@query_budget(5)
 def get_canvas(username):
-    user = User.by_name(username)
-    if not user:
+    # Don't undefer the data, since the client might already have it.
+    relation = current_user.relation(username, canvas=True)
+    if not relation:
         return error(404, "unknown_user", "No user has that username")
-    friendship = (
-        Friendship.between(current_user, user, query=True)
-        .options(joinedload(Friendship.canvas).undefer(Canvas.data))
-        .first()
-    )
-    reverse_friendship = Friendship.between(user, current_user)
+    friendship = relation.friendship
+    reverse_friendship = relation.reverse_friendship
     if not (friendship and reverse_friendship):
         return error(404, "not_friends", "Not friends with that user")
     assert not friendship.ignored
@@ -247,36 +338,167 @@ def get_canvas(username):
         db.session.add(friendship)
         db.session.add(reverse_friendship)
         db.session.commit()
-    data = friendship.canvas.data
-    if not data:
-        return jsonify(None)
-    return jsonify(b64encode(data).decode())
+    canvas_id = friendship.canvas.id
+    seen_id = request.args.get("id", type=int)
+    version = request.args.get("version", type=int)
+    fade_level = request.args.get("fade", type=int)
+
+    def canvas_state():
+        # Look the canvas up again, since it could be deleted while waiting.
+        canvas = Canvas.query.get(canvas_id)
+        if not canvas:
+            return None
+        return canvas.id, canvas.version, canvas.fade_level(), wants_binary()
+
+    state = wait_for_change(canvas_topic(canvas_id), canvas_state)
+    if not state:
+        return error(404, "not_friends", "Not friends with that user")
+    response = conditional(
+        state,
+        lambda: canvas_response(
+            Canvas.query.get(canvas_id), version, fade_level, seen_id
+        ),
+    )
+    # The body is JSON or PNG depending on Accept, so caches must key on it.
+    response.vary.add("Accept")
+    return response
 
 
-@app.route("/api/friends/<username>/sync", methods=["POST"])
+@blueprint.route("/api/friends/<username>/thumbnail/<key>")
 @login_required
 @logged_in_limit
-def sync(username):
-    base64_data = get_fields("data")
-    try:
-        data = b64decode(base64_data)
-    except binascii.Error:
-        return error(400, "bad_base64", "Could not decode base64 data")
-    user = User.by_name(username)
-    if not user:
+@query_budget(3)
+def get_thumbnail(username, key):
+    relation = current_user.relation(username, canvas=True)
+    if not relation:
         return error(404, "unknown_user", "No user has that username")
-    canvas = (
-        Canvas.query.options(undefer(Canvas.data), undefer(Canvas.thumbnail))
-        .join(Canvas.friendships)
-        .filter(
-            Friendship.friender == current_user, Friendship.friendee == user
-        )
-        .with_for_update(of=Canvas)
-        .first()
-    )
+    friendship = relation.friendship
+    reverse_friendship = relation.reverse_friendship
+    if not (friendship and reverse_friendship):
+        return error(404, "not_friends", "Not friends with that user")
+    canvas = friendship.canvas
+    if not canvas or canvas.thumbnail_key() != key:
+        return error(404, "unknown_thumbnail", "No thumbnail has that key")
+    # The key changes whenever the content does, so clients can cache forever.
+    response = Response(canvas.faded_thumbnail(), mimetype="image/png")
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    response.set_etag(key)
+    return response.make_conditional(request)
+
+
+@blueprint.route("/api/friends/<username>/sync", methods=["POST"])
+@login_required
+@logged_in_limit
+@query_budget(8)
+def sync(username):
+    data, seen_id, version, fade_level, offset = get_layer()
+    # Don't undefer the data, since mix can often use a cached image instead.
+    canvas = current_user.shared_canvas(username)
     if not canvas:
+        if not User.by_name(username):
+            return error(404, "unknown_user", "No user has that username")
         return error(404, "not_friends", "Not friends with that user")
-    data = canvas.mix(data)
+    try:
+        image = canvas.mix(data, offset)
+    except InvalidAttribute as ex:
+        return error(422, "invalid_field", ex.message, field=ex.attribute)
+    if image is None:
+        # Nothing visible was drawn, so just release the lock.
+        db.session.commit()
+        return canvas_response(canvas, version, fade_level, seen_id)
     db.session.add(canvas)
+    notify(canvas_topic(canvas.id))
+    # Respond from the canvas as written, rather than loading it (and its
+    # blob) again after the commit.
+    commit_detached(canvas)
+    thumbnails.submit(canvas.id, canvas.version, image)
+    return canvas_response(canvas, version, fade_level, seen_id)
+
+
+def commit_detached(instance):
+    """Commit, detaching an instance so the commit doesn't expire it."""
+    db.session.flush()
+    db.session.expunge(instance)
     db.session.commit()
-    return jsonify(b64encode(data).decode())
+
+
+def get_layer():
+    """Get the uploaded layer and the client's canvas state for a sync.
+
+    The layer is either raw PNG data, with the rest in query parameters, or
+    base64 data in a JSON body. Returns (data, id, version, fade, offset).
+    """
+    if is_binary():
+        args = request.args
+        data = request.get_data()
+        seen_id = args.get("id", type=int)
+        version = args.get("version", type=int)
+        fade_level = args.get("fade", type=int)
+        try:
+            offset = [int(x) for x in args.get("offset", "0,0").split(",")]
+        except ValueError:
+            offset = None
+    else:
+        json = get_json(
+            required=["data"], permitted=["id", "version", "fade", "offset"]
+        )
+        try:
+            data = b64decode(json["data"])
+        except binascii.Error:
+            abort_json(400, "bad_base64", "Could not decode base64 data")
+        seen_id = json.get("id")
+        version = json.get("version")
+        fade_level = json.get("fade")
+        offset = json.get("offset", [0, 0])
+    state = seen_id, version, fade_level
+    if not all(isinstance(x, (int, type(None))) for x in state):
+        abort_json(400, "bad_version", "ID, version, and fade must be integers")
+    if not isinstance(offset, list) or [type(x) for x in offset] != [int, int]:
+        abort_json(400, "bad_offset", "Offset must be a pair of integers")
+    return data, seen_id, version, fade_level, tuple(offset)
+
+
+def canvas_response(canvas, version=None, fade_level=None, seen_id=None):
+    """Respond with canvas data, as JSON or raw PNG depending on the client.
+
+    If the client gives a version, this sends only the part of the canvas that
+    changed since then. Clients should send back the canvas ID, version, and
+    fade level they last saw, since fading changes the whole canvas without
+    bumping the version, and a new canvas starts from version 0 again. In
+    binary responses, these go in X-Canvas-* headers, and 204 No Content means
+    there is nothing new to draw.
+    """
+    response = canvas_body(canvas, version, fade_level, seen_id)
+    response.vary.add("Accept")
+    return response
+
+
+def canvas_body(canvas, version, fade_level, seen_id):
+    if version is None:
+        data = canvas.faded_data()
+        if wants_binary():
+            return binary(data) if data else binary(b"", status=204)
+        return jsonify(b64encode(data).decode() if data else None)
+    now = datetime.utcnow()
+    box = canvas.changed_region(version, fade_level, now, seen_id)
+    info = {
+        "id": canvas.id,
+        "version": canvas.version,
+        "fade": canvas.fade_level(now),
+    }
+    # Check last_fade rather than data, so cached images can be used instead.
+    data = box and canvas.last_fade and canvas.render_region(box, now)
+    if wants_binary():
+        headers = {f"X-Canvas-{k.title()}": v for k, v in info.items()}
+        if not data:
+            return binary(b"", status=204, headers=headers)
+        headers["X-Canvas-Offset"] = f"{box[0]},{box[1]}"
+        return binary(data, headers=headers)
+    if box is None:
+        return jsonify(**info, unchanged=True)
+    return jsonify(
+        **info,
+        unchanged=False,
+        data=b64encode(data).decode() if data else None,
+        offset=box[:2],
+    )
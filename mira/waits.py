@@ -0,0 +1,218 @@
+"""This module serves long-polling requests from an event loop.
+
+Waitress runs each request on one of a few threads until it returns, so it
+can't hold requests open while they wait for changes. Instead, mira.server
+can give each worker a second listener (--wait-port) for long-polls. Requests
+on it run through the app as usual, on a couple of threads, but if the
+client's ETag still matches, wait_for_change parks the request here rather
+than blocking. The event loop then holds it until a change to the topic is
+published or the wait times out, and runs it through the app again.
+
+Route the wait listener under the same origin as the site (with a reverse
+proxy, for example), and build the Vue app with VUE_APP_WAIT_BACKEND pointing
+at it. Without one, clients still send long-polls to the API, which answers
+them right away, so they fall back to polling.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from threading import Thread
+from urllib.parse import unquote_to_bytes
+import asyncio
+import sys
+
+from werkzeug.test import run_wsgi_app
+
+from mira.notifications import broker
+
+
+# Threads that run requests through the app. Each holds a pooled database
+# connection briefly, so keep this within DB_MAX_OVERFLOW.
+CHECK_THREADS = 2
+# Request heads bigger than this are refused.
+MAX_HEAD_BYTES = 16 * 1024
+# How long a connection may sit idle between requests.
+IDLE_SECONDS = 60
+
+
+class ParkedWait:
+    """Where wait_for_change records what a parked request waits for."""
+
+    def __init__(self):
+        self.topic = None
+        self.token = None
+        self.timeout = None
+
+    def park(self, topic, token, timeout):
+        self.topic = topic
+        self.token = token
+        self.timeout = timeout
+
+
+class WaitServer:
+    """Event loop thread that serves long-polls on a listening socket."""
+
+    def __init__(self, application, listener, max_waiters):
+        self.application = application
+        self.listener = listener
+        self.max_waiters = max_waiters
+        self.executor = ThreadPoolExecutor(CHECK_THREADS)
+        self.loop = asyncio.new_event_loop()
+        # Maps topics to futures for the requests waiting on them.
+        self.waiting = {}
+        self.parked = 0
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+        broker.subscribe(self.published)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(
+            asyncio.start_server(
+                self.serve_connection,
+                sock=self.listener,
+                limit=MAX_HEAD_BYTES,
+            )
+        )
+        self.loop.run_forever()
+
+    def published(self, topic):
+        # This runs on the publishing thread, under the broker's lock.
+        self.loop.call_soon_threadsafe(self.wake, topic)
+
+    def wake(self, topic):
+        for future in self.waiting.pop(topic, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def serve_connection(self, reader, writer):
+        try:
+            keep_alive = True
+            while keep_alive:
+                head = await asyncio.wait_for(
+                    reader.readuntil(b"\r\n\r\n"), IDLE_SECONDS
+                )
+                keep_alive = await self.serve_request(head, writer)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except (asyncio.LimitOverrunError, ValueError):
+            writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_request(self, head, writer):
+        """Respond to a request, and return whether to keep the connection."""
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, protocol = lines[0].split(" ")
+        headers = [line.split(":", 1) for line in lines[1:] if line]
+        headers = [(name.strip(), value.strip()) for name, value in headers]
+        names = {name.lower(): value for name, value in headers}
+        if method not in ("GET", "HEAD") or "transfer-encoding" in names:
+            raise ValueError("Only GET and HEAD requests can wait")
+        if int(names.get("content-length", 0)):
+            raise ValueError("Requests that wait can't have bodies")
+        peer = writer.get_extra_info("peername")
+        environ = make_environ(method, target, protocol, headers, peer)
+        parked = ParkedWait()
+        # Past the limit, answer right away, leaving the client to poll.
+        full = self.parked >= self.max_waiters
+        environ["mira.wait"] = None if full else parked
+        response = await self.call(environ)
+        if parked.topic is not None:
+            self.parked += 1
+            try:
+                await self.changed(parked.topic, parked.token, parked.timeout)
+            finally:
+                self.parked -= 1
+            # Check again, this time without waiting.
+            environ = make_environ(method, target, protocol, headers, peer)
+            environ["mira.wait"] = None
+            response = await self.call(environ)
+        status, response_headers, body = response
+        keep_alive = protocol == "HTTP/1.1" and (
+            names.get("connection", "").lower() != "close"
+        )
+        lines = [f"{protocol} {status}"]
+        lines.extend(f"{name}: {value}" for name, value in response_headers)
+        if "Content-Length" not in response_headers:
+            lines.append(f"Content-Length: {len(body)}")
+        lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+        writer.write("\r\n".join(lines).encode("latin-1") + b"\r\n\r\n")
+        if method != "HEAD":
+            writer.write(body)
+        await writer.drain()
+        return keep_alive
+
+    async def call(self, environ):
+        """Run a request through the app on a thread."""
+        return await self.loop.run_in_executor(
+            self.executor, call_application, self.application, environ
+        )
+
+    async def changed(self, topic, token, timeout):
+        """Wait until the topic changes from the token, or the timeout."""
+        future = self.loop.create_future()
+        self.waiting.setdefault(topic, set()).add(future)
+        try:
+            # Changes published before the future was added don't wake it.
+            if broker.token(topic) == token:
+                await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            futures = self.waiting.get(topic)
+            if futures:
+                futures.discard(future)
+                if not futures:
+                    del self.waiting[topic]
+
+
+def call_application(application, environ):
+    """Return the status, headers, and body of a WSGI response."""
+    app_iter, status, headers = run_wsgi_app(
+        application, environ, buffered=True
+    )
+    try:
+        body = b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return status, headers, body
+
+
+def make_environ(method, target, protocol, headers, peer):
+    """Build a WSGI environment for a request without a body."""
+    path, _, query = target.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": protocol,
+        "REMOTE_ADDR": peer[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in headers:
+        key = name.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        if key in environ:
+            value = f"{environ[key]},{value}"
+        environ[key] = value
+    return environ
+
+
+def serve_waits(app, listener):
+    """Serve long-polls for an app on a listener from this process."""
+    WaitServer(app, listener, app.config["NOTIFY_MAX_WAITERS"]).start()
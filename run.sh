@@ -11,6 +11,7 @@ vue_config_path="web/.env.development.local"
 default_dev_port=5000
 default_web_port=8080
 default_test_port=5050
+default_load_port=5060
 normal_postgres_port=5432
 test_postgres_port=5431
 
@@ -32,6 +33,7 @@ postgres_log_path=
 migration_dir=
 postgres_port=$normal_postgres_port
 pytest_filter=
+load_args=()
 
 say() {
     echo " * $*"
@@ -59,6 +61,7 @@ commands:
     web         start the vue server
     prod        build and start the prod server
     test        run api tests
+    load        run the load test (pass harness options after --)
     install     install development dependencies
     lint        format and lint code
     deploy      deploy to heroku
@@ -144,6 +147,7 @@ run_prod() {
     else
         say "Building the vue app for production"
         VUE_APP_BACKEND="http://localhost:$port/api/" yarn_do run build
+        compress_assets
     fi
     if ! [[ -d "$postgres_dir" ]]; then
         create_db
@@ -151,8 +155,16 @@ run_prod() {
     start_db
     say "Serving the flask app in production mode using waitress on port $port"
     say "WARNING: DO NOT USE THIS SCRIPT IN REAL PRODUCTION! HTTPS IS DISABLED!"
+    metrics_dir=$(mktemp -d)
     FLASK_ENV="production" FLASK_FORCE_HTTPS=no \
-        python3 -m waitress --port "$port" "$flask_app"
+        prometheus_multiproc_dir="$metrics_dir" \
+        python3 -m mira.server --port "$port"
+}
+
+compress_assets() {
+    gen_flask_config
+    say "Precompressing static files"
+    run flask_do compress-assets
 }
 
 run_test() {
@@ -188,6 +200,42 @@ EOS
     return $status
 }
 
+run_load() {
+    : "${port:=$default_load_port}"
+    # Share the test database cluster, but start from a clean slate.
+    postgres_port=$test_postgres_port
+    db_url=$(database_url "$postgres_port")
+    export DATABASE_URL=$db_url
+    gen_flask_config
+    if ! [[ -d "$postgres_dir" ]]; then
+        create_db
+    fi
+    start_db
+    say "Clearing load test database"
+    run psql -p "$postgres_port" -d "$database_name" <<EOS
+DELETE FROM users;
+DELETE FROM friendships;
+DELETE FROM canvases;
+EOS
+    say "Starting the server for load testing (logs in flask_load.log)"
+    metrics_dir=$(mktemp -d)
+    FLASK_ENV="benchmark" prometheus_multiproc_dir="$metrics_dir" \
+        python3 -m mira.server --port "$port" > flask_load.log 2>&1 &
+    server_pid=$!
+    sleep 3
+    say "Running load test"
+    status=0
+    python3 tests/load/loadtest.py --url "http://localhost:$port" \
+        "${load_args[@]+"${load_args[@]}"}" || status=$?
+    say "Checking query plans against the seeded database"
+    flask_do explain-queries --check || status=$?
+    say "Stopping the server"
+    kill "$server_pid"
+    wait "$server_pid" || :
+    stop_db
+    return $status
+}
+
 run_deploy() {
     if ! git diff-index --quiet HEAD --; then
         say "Working directory is not clean"
@@ -204,6 +252,7 @@ run_deploy() {
     git checkout "$deploy_branch"
     say "Building the vue app for production"
     yarn_do run build
+    compress_assets
     say "Committing build files"
     git add --all -f dist/
     git commit -m "Deploy of $commit"
@@ -379,6 +428,7 @@ main() {
         web) run_web ;;
         prod) run_prod ;;
         test) run_test ;;
+        load) run_load ;;
         install) install_deps ;;
         lint) lint_code ;;
         deploy) run_deploy ;;
@@ -412,6 +462,11 @@ while getopts "hvsk:d:p:" opt; do
 done
 
 shift $((OPTIND - 1))
+# Anything after -- goes to the load test harness.
+if [[ "$cmd" == "load" ]]; then
+    load_args=("$@")
+    set --
+fi
 if [[ $# -eq 1 ]]; then
     cmd=$1
 elif [[ $# -gt 1 ]]; then
@@ -422,7 +477,7 @@ fi
 if [[ -z "$db_env" ]]; then
     if [[ "$cmd" == "prod" ]]; then
         set_db_env "prod"
-    elif [[ "$cmd" == "test" ]]; then
+    elif [[ "$cmd" == "test" || "$cmd" == "load" ]]; then
         set_db_env "test"
     elif [[ -s "$db_env_path" ]]; then
         set_db_env "$(< "$db_env_path")"
@@ -0,0 +1,255 @@
+"""This script benchmarks canvas compositing, fading, and encoding.
+
+Each case times one operation from Canvas.mix or its helpers over several
+repetitions, with setup (and cache clearing) left out of the timings, and
+measures how far the operation raises peak memory above where it started.
+Pixel buffers are allocated by Pillow, not Python, so memory is measured as
+resident set size: exactly on Linux, and as an upper bound elsewhere. Memory
+the allocator reuses from earlier repetitions doesn't count, so compare peaks
+between runs rather than reading them as totals.
+
+Results are printed and can be saved as JSON, and a saved run can be given
+to --compare to show how each case changed:
+
+    python3 tests/bench/bench_canvas.py --save before.json
+    python3 tests/bench/bench_canvas.py --compositor numpy --compare before.json
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+from io import BytesIO
+from random import Random
+from statistics import median
+from time import perf_counter
+import json
+import os
+import platform
+import resource
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from PIL import Image, ImageDraw, __version__ as pillow_version  # noqa: E402
+
+from mira import create_app  # noqa: E402
+from mira.codecs import CODECS  # noqa: E402
+from mira.models import (  # noqa: E402
+    CANVAS_SIZE,
+    FADE_PERIOD,
+    Canvas,
+    encode_image,
+    faded_cache,
+    image_cache,
+    render_thumbnail,
+)
+
+
+# Layer sizes and stroke counts, and the strokes on a full canvas.
+LAYERS = {"small": ((32, 32), 2), "large": ((400, 400), 40)}
+FULL_CANVAS_STROKES = 400
+MANY_FADES = 24
+
+
+def main():
+    # The app needs these, but no database is used.
+    app = create_app(
+        {"SECRET_KEY": "benchmark", "SQLALCHEMY_DATABASE_URI": "sqlite://"}
+    )
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--compositor", default=app.config["CANVAS_COMPOSITOR"]
+    )
+    parser.add_argument("--filter", default="", help="only run matching cases")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare with a saved JSON file")
+    args = parser.parse_args()
+    app.config["CANVAS_COMPOSITOR"] = args.compositor
+    results = {
+        "compositor": args.compositor,
+        "python": platform.python_version(),
+        "pillow": pillow_version,
+        "repeat": args.repeat,
+        "cases": {},
+    }
+    with app.app_context():
+        for name, setup, operation in cases():
+            if args.filter in name:
+                results["cases"][name] = run_case(
+                    setup, operation, args.repeat
+                )
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["cases"]
+    print_results(results["cases"], baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def cases():
+    """Yield (name, setup, operation) for each case.
+
+    Setup returns the argument for the operation, and runs untimed before
+    every repetition.
+    """
+    for layer_name, (layer_size, strokes) in LAYERS.items():
+        layer = encode_image(drawing(layer_size, strokes, seed=1))
+        yield (
+            f"mix/empty/{layer_name}",
+            lambda: Canvas(),
+            lambda canvas, layer=layer: canvas.mix(layer, (50, 50)),
+        )
+        for fades in 0, 1, MANY_FADES:
+            yield (
+                f"mix/full/{layer_name}/fades={fades}",
+                lambda fades=fades: full_canvas(fades),
+                lambda canvas, layer=layer: canvas.mix(layer, (50, 50)),
+            )
+        yield (
+            f"mix/full/{layer_name}/cached",
+            lambda: full_canvas(0, cached=True),
+            lambda canvas, layer=layer: canvas.mix(layer, (50, 50)),
+        )
+    whole = encode_image(full_image())
+    yield (
+        "mix/empty/whole",
+        lambda: Canvas(),
+        lambda canvas: canvas.mix(whole),
+    )
+    yield ("thumbnail", full_image, render_thumbnail)
+    for level in 1, 6, 9:
+        yield (
+            f"encode/level={level}",
+            full_image,
+            lambda image, level=level: encode(image, level),
+        )
+    for name, codec in CODECS.items():
+        try:
+            data = codec.encode(full_image())
+        except (ImportError, KeyError, OSError) as ex:
+            print(f"Skipping codec {name}: {ex!r}", file=sys.stderr)
+            continue
+        yield (f"codec/{name}/encode", full_image, codec.encode)
+        yield (f"codec/{name}/decode", lambda data=data: data, codec.decode)
+
+
+def run_case(setup, operation, repeat):
+    """Time an operation and measure its peak memory."""
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        clear_caches()
+        argument = setup()
+        start_rss = reset_peak_rss()
+        start = perf_counter()
+        result = operation(argument)
+        times.append(perf_counter() - start)
+        peak = max(peak, peak_rss() - start_rss)
+        size = len(result) if isinstance(result, bytes) else None
+        del argument, result
+    return {
+        "median_ms": round(median(times) * 1000, 3),
+        "min_ms": round(min(times) * 1000, 3),
+        "peak_kib": peak,
+        "bytes": size,
+    }
+
+
+def full_canvas(fades, cached=False):
+    """Make a well-used canvas, with the given fades pending."""
+    canvas = Canvas(id=1, version=1)
+    image = full_image()
+    canvas.data = encode_image(image)
+    # Stay clear of period boundaries, so the fade count is stable.
+    elapsed = fades * FADE_PERIOD + FADE_PERIOD / 2
+    canvas.last_fade = datetime.utcnow() - elapsed
+    if cached:
+        image_cache.set((canvas.id, canvas.version), image)
+    return canvas
+
+
+def full_image():
+    return drawing(CANVAS_SIZE, FULL_CANVAS_STROKES)
+
+
+def drawing(size, strokes, seed=0):
+    """Make a repeatable image of random strokes on a transparent canvas."""
+    rng = Random(seed)
+    image = Image.new("RGBA", size)
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    for _ in range(strokes):
+        points = [
+            (rng.randrange(width), rng.randrange(height)) for _ in range(8)
+        ]
+        color = tuple(rng.randrange(256) for _ in range(3)) + (255,)
+        draw.line(points, fill=color, width=rng.randint(2, 12))
+    return image
+
+
+def encode(image, level):
+    """Encode an image as PNG at a zlib compression level."""
+    f = BytesIO()
+    image.save(f, "PNG", compress_level=level)
+    return f.getvalue()
+
+
+def clear_caches():
+    image_cache.clear()
+    faded_cache.clear()
+
+
+def reset_peak_rss():
+    """Reset the peak RSS if the OS allows it, and return the current RSS."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return proc_status("VmRSS")
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in KiB."""
+    try:
+        return proc_status("VmHWM")
+    except OSError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes rather than KiB.
+        return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def proc_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name == field:
+                return int(value.split()[0])
+    raise OSError(f"{field} not in /proc/self/status")
+
+
+def print_results(cases, baseline=None):
+    columns = ["median_ms", "min_ms", "peak_kib", "bytes"]
+    header = f"{'case':<32}" + "".join(f"{c:>12}" for c in columns)
+    if baseline:
+        header += f"{'vs median':>12}{'vs peak':>12}"
+    print(header)
+    for name, row in cases.items():
+        line = f"{name:<32}" + "".join(
+            f"{'-' if row.get(c) is None else row[c]:>12}" for c in columns
+        )
+        old = baseline and baseline.get(name)
+        if old:
+            line += f"{ratio(row['median_ms'], old['median_ms']):>12}"
+            line += f"{ratio(row['peak_kib'], old['peak_kib']):>12}"
+        print(line)
+
+
+def ratio(new, old):
+    return f"{new / old:.2f}x" if old else "-"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""This script load-tests a running server with a realistic mix of requests.
+
+It seeds users in groups of MAX_FRIENDS + 1, where everyone in a group is
+friends with everyone else, so each user has a full friends list and every
+canvas is shared by two users who sync it concurrently. Then each user polls
+friends data, fetches canvases, syncs layers, and occasionally logs in again,
+and the script reports throughput and latency percentiles per endpoint.
+
+Seeding is idempotent and runs are seeded, so rerunning against the same
+database replays the same workload. Start the server with './run.sh load',
+or run this directly against one that is already up:
+
+    python3 tests/load/loadtest.py --url http://localhost:5060 --users 70
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from random import Random
+from time import monotonic, sleep
+import json
+import sys
+
+from PIL import Image
+import requests
+
+
+# Matches mira.models.MAX_FRIENDS.
+MAX_FRIENDS = 6
+CANVAS_SIZE = 500, 500
+PASSWORD = "load-test-password"
+
+# Relative frequency of each action. Clients poll much more than they draw.
+MIX = {"friends_data": 50, "canvas": 20, "sync": 25, "login": 5}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5060")
+    parser.add_argument("--users", type=int, default=7 * (MAX_FRIENDS + 1))
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument(
+        "--think", type=float, default=0.1, help="mean seconds between actions"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--prefix", default="load")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    url = args.url.rstrip("/")
+    names = [f"{args.prefix}{i:05}" for i in range(args.users)]
+    print(f"Seeding {len(names)} users at {url}", file=sys.stderr)
+    clients = seed(url, names)
+    print(f"Running for {args.duration} seconds", file=sys.stderr)
+    stats = run(clients, args.duration, args.think, args.seed)
+    report = summarize(stats, args.duration)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if any(r["errors"] for r in report["endpoints"].values()):
+        sys.exit(1)
+
+
+class Client:
+    """A logged-in user and the state its web client would keep."""
+
+    def __init__(self, url, username, friends):
+        self.url = url
+        self.username = username
+        self.friends = friends
+        self.session = requests.Session()
+        self.friends_etag = None
+        # Friend name -> (version, fade) of the canvas as last seen.
+        self.canvases = {}
+
+    def request(self, method, path, **kwargs):
+        response = self.session.request(method, self.url + path, **kwargs)
+        if response.status_code >= 400:
+            raise RequestFailed(response)
+        return response
+
+    def register(self):
+        body = {"username": self.username, "password": PASSWORD}
+        try:
+            self.request("POST", "/api/register", json=body)
+        except RequestFailed as ex:
+            # Already seeded by an earlier run.
+            if ex.response.status_code != 409:
+                raise
+
+    def login(self):
+        body = {"username": self.username, "password": PASSWORD}
+        self.request("POST", "/api/login", json=body)
+
+    def add_friends(self):
+        for friend in self.friends:
+            self.request("PUT", f"/api/friends/{friend}")
+
+    def poll_friends_data(self, rng):
+        headers = {}
+        if self.friends_etag:
+            headers["If-None-Match"] = f'"{self.friends_etag}"'
+        response = self.request("GET", "/api/friends_data", headers=headers)
+        self.friends_etag = response.headers.get("ETag", "").strip('"')
+
+    def fetch_canvas(self, rng):
+        friend = rng.choice(self.friends)
+        version, fade = self.canvases.get(friend, (0, None))
+        params = {"version": version}
+        if fade is not None:
+            params["fade"] = fade
+        response = self.request(
+            "GET",
+            f"/api/friends/{friend}/canvas",
+            params=params,
+            headers={"Accept": "image/png"},
+        )
+        self.remember(friend, response)
+
+    def sync(self, rng):
+        friend = rng.choice(self.friends)
+        version, fade = self.canvases.get(friend, (0, None))
+        layer, offset = random_layer(rng)
+        params = {"version": version, "offset": "{},{}".format(*offset)}
+        if fade is not None:
+            params["fade"] = fade
+        response = self.request(
+            "POST",
+            f"/api/friends/{friend}/sync",
+            params=params,
+            data=layer,
+            headers={"Content-Type": "image/png", "Accept": "image/png"},
+        )
+        self.remember(friend, response)
+
+    def remember(self, friend, response):
+        headers = response.headers
+        if "X-Canvas-Version" in headers:
+            self.canvases[friend] = (
+                int(headers["X-Canvas-Version"]),
+                int(headers["X-Canvas-Fade"]),
+            )
+
+
+class RequestFailed(Exception):
+    def __init__(self, response):
+        super().__init__(f"{response.status_code} {response.url}")
+        self.response = response
+
+
+def seed(url, names):
+    """Create and log in all users, and return a client for each."""
+    group = MAX_FRIENDS + 1
+    clients = []
+    for start in range(0, len(names), group):
+        members = names[start:][:group]
+        for name in members:
+            friends = [n for n in members if n != name]
+            clients.append(Client(url, name, friends))
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda c: c.register(), clients))
+        list(executor.map(lambda c: c.login(), clients))
+    # Add friends in order, so the second request of each pair accepts the
+    # first one instead of racing with it.
+    for client in clients:
+        client.add_friends()
+    # Leftover users in a partial last group may have no friends.
+    return [c for c in clients if c.friends]
+
+
+def run(clients, duration, think, seed):
+    """Drive all clients at once, and return their (action, seconds, ok)."""
+    deadline = monotonic() + duration
+    actions = list(MIX)
+    weights = list(MIX.values())
+
+    def drive(index):
+        client = clients[index]
+        rng = Random(seed * 1000003 + index)
+        samples = []
+        while monotonic() < deadline:
+            if think > 0:
+                sleep(rng.expovariate(1 / think))
+            action = rng.choices(actions, weights)[0]
+            start = monotonic()
+            try:
+                if action == "friends_data":
+                    client.poll_friends_data(rng)
+                elif action == "canvas":
+                    client.fetch_canvas(rng)
+                elif action == "sync":
+                    client.sync(rng)
+                else:
+                    client.login()
+                ok = True
+            except (RequestFailed, requests.RequestException) as ex:
+                print(f"{action}: {ex}", file=sys.stderr)
+                ok = False
+            samples.append((action, monotonic() - start, ok))
+        return samples
+
+    with ThreadPoolExecutor(len(clients)) as executor:
+        results = executor.map(drive, range(len(clients)))
+        return [sample for samples in results for sample in samples]
+
+
+def random_layer(rng):
+    """Make a small PNG stroke and a random offset where it fits."""
+    width, height = rng.randint(8, 64), rng.randint(8, 64)
+    color = tuple(rng.randrange(256) for _ in range(3)) + (255,)
+    image = Image.new("RGBA", (width, height), color)
+    f = BytesIO()
+    image.save(f, "PNG")
+    offset = (
+        rng.randrange(CANVAS_SIZE[0] - width),
+        rng.randrange(CANVAS_SIZE[1] - height),
+    )
+    return f.getvalue(), offset
+
+
+def summarize(stats, duration):
+    """Compute throughput and latency percentiles for each endpoint."""
+    endpoints = {}
+    for action in [*MIX, "total"]:
+        samples = [s for s in stats if action == "total" or s[0] == action]
+        times = sorted(seconds for _, seconds, _ in samples)
+        endpoints[action] = {
+            "requests": len(times),
+            "errors": sum(not ok for _, _, ok in samples),
+            "per_second": round(len(times) / duration, 2),
+            **{
+                f"p{p}_ms": round(percentile(times, p) * 1000, 1)
+                for p in (50, 95, 99)
+            },
+        }
+    return {"duration_seconds": duration, "endpoints": endpoints}
+
+
+def percentile(values, p):
+    """Get the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0
+    rank = max(1, -(-len(values) * p // 100))
+    return values[rank - 1]
+
+
+def print_report(report):
+    columns = ["requests", "errors", "per_second", "p50_ms", "p95_ms", "p99_ms"]
+    print(f"{'endpoint':<14}" + "".join(f"{c:>12}" for c in columns))
+    for name, row in report["endpoints"].items():
+        print(f"{name:<14}" + "".join(f"{row[c]:>12}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
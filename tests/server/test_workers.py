@@ -0,0 +1,126 @@
+"""Check that state cached per process stays correct across workers.
+
+These tests start mira.server with two workers against the Postgres database
+in DATABASE_URL (which './run.sh test' sets up), and skip without one.
+"""
+
+from threading import Timer
+from time import monotonic, sleep
+import os
+import socket
+import subprocess
+import sys
+import uuid
+
+import pytest
+import requests
+
+
+WORKERS = 2
+# Requests to spread over the workers, each on a new connection.
+ATTEMPTS = 20
+# How long a notification may take to reach the other workers.
+NOTIFY_DELAY_SECONDS = 0.5
+
+
+@pytest.fixture(scope="module")
+def server():
+    if not os.getenv("DATABASE_URL", "").startswith("postgres"):
+        pytest.skip("Needs a Postgres DATABASE_URL")
+    port, wait_port = free_port(), free_port()
+    env = {
+        **os.environ,
+        "FLASK_ENV": "testing",
+        "FLASK_SERVER_WORKERS": str(WORKERS),
+        "FLASK_NOTIFY_BACKEND": "postgres",
+    }
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "mira.server",
+            "--port",
+            str(port),
+            "--wait-port",
+            str(wait_port),
+        ],
+        env=env,
+    )
+    url = f"http://localhost:{port}"
+    deadline = monotonic() + 30
+    while True:
+        try:
+            requests.get(f"{url}/api/check")
+            break
+        except requests.ConnectionError:
+            if monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                pytest.fail("The server didn't start")
+            sleep(0.2)
+    yield url, f"http://localhost:{wait_port}"
+    process.terminate()
+    process.wait()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def register(url, username):
+    session = requests.Session()
+    credentials = {"username": username, "password": "password1"}
+    assert session.post(f"{url}/api/register", json=credentials).ok
+    assert session.post(f"{url}/api/login", json=credentials).ok
+    return session
+
+
+def check_statuses(url, cookies):
+    """Check the login on new connections, so every worker sees some."""
+    return {
+        requests.get(
+            f"{url}/api/check",
+            cookies=cookies,
+            headers={"Connection": "close"},
+        ).status_code
+        for _ in range(ATTEMPTS)
+    }
+
+
+def test_password_change_revokes_login_in_every_worker(server):
+    server, _ = server
+    session = register(server, f"workers-{uuid.uuid4().hex[:8]}")
+    cookies = session.cookies.get_dict()
+    # Load the user into each worker's cache.
+    assert check_statuses(server, cookies) == {200}
+    response = session.put(
+        f"{server}/api/change_password",
+        json={"password": "password1", "new_password": "password2"},
+    )
+    assert response.ok
+    sleep(NOTIFY_DELAY_SECONDS)
+    assert check_statuses(server, cookies) == {401}
+
+
+def test_long_poll_wakes_on_change(server):
+    server, wait_server = server
+    names = [f"waits-{uuid.uuid4().hex[:8]}" for _ in range(2)]
+    waiter, friend = [register(server, name) for name in names]
+    etag = waiter.get(f"{server}/api/friends").headers["ETag"]
+    # Change the friends list from a new connection, so possibly another
+    # worker, while the long-poll waits.
+    Timer(
+        1,
+        lambda: friend.put(
+            f"{server}/api/friends/{names[0]}", headers={"Connection": "close"}
+        ),
+    ).start()
+    start = monotonic()
+    response = waiter.get(
+        f"{wait_server}/api/friends?wait=10",
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert response.json()["incoming_requests"] == [names[1]]
+    assert monotonic() - start < 5
@@ -0,0 +1,25 @@
+"""Fixtures for unit tests that need the app.
+
+Each test gets its own app, with a throwaway SQLite database and an app
+context. Import mira modules that need the app inside tests, after requesting
+this fixture.
+"""
+
+import pytest
+
+
+@pytest.fixture
+def app(tmp_path):
+    from mira import create_app
+    from mira.extensions import db
+
+    app = create_app(
+        {
+            "ENV": "testing",
+            "SECRET_KEY": "testing",
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/mira.sqlite",
+        }
+    )
+    with app.app_context():
+        db.create_all()
+        yield app
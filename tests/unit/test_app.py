@@ -0,0 +1,39 @@
+"""Check that create_app builds independent apps without loading Pillow."""
+
+import subprocess
+import sys
+
+
+def test_apps_are_isolated(app, tmp_path):
+    from mira import create_app
+    from mira.extensions import db
+    from mira.models import User
+
+    db.session.add(User("alice", "password1"))
+    db.session.commit()
+    other = create_app(
+        {
+            "ENV": "testing",
+            "SECRET_KEY": "testing",
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path}/other.sqlite",
+        }
+    )
+    # Sessions belong to threads rather than app contexts, so end this one.
+    db.session.remove()
+    with other.app_context():
+        db.create_all()
+        assert User.query.count() == 0
+        assert other.test_client().get("/api/check").status_code == 401
+    assert User.query.count() == 1
+
+
+def test_create_app_defers_pillow():
+    code = (
+        "import sys\n"
+        "from mira import create_app\n"
+        "config = {'SECRET_KEY': 'x', 'SQLALCHEMY_DATABASE_URI': 'sqlite://'}\n"
+        "create_app(config)\n"
+        "print(sorted({'PIL', 'numpy'} & set(sys.modules)))\n"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.strip() == b"[]"
@@ -0,0 +1,48 @@
+"""Check that the NumPy compositor matches the Pillow one, up to rounding."""
+
+import random
+
+from PIL import Image, ImageChops
+import pytest
+
+from mira.compositing import NumPyCompositor, PILCompositor
+
+
+# Rounding differs between the engines, but never by more than this.
+TOLERANCE = 2
+
+
+def random_image(size, seed):
+    rng = random.Random(seed)
+    data = bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * 4))
+    return Image.frombytes("RGBA", size, data)
+
+
+def max_difference(a, b):
+    bands = ImageChops.difference(a, b).getextrema()
+    return max(high for _, high in bands)
+
+
+@pytest.mark.parametrize("alpha_multiplier", [1, 0.95, 0.95 ** 24])
+@pytest.mark.parametrize(
+    "layer_size, offset",
+    [((64, 64), (0, 0)), ((24, 40), (17, 5)), ((10, 30), (54, 34))],
+)
+def test_composite_matches(alpha_multiplier, layer_size, offset):
+    base = random_image((64, 64), seed=1)
+    layer = random_image(layer_size, seed=2)
+    expected = PILCompositor().composite(
+        base.copy(), layer, offset, alpha_multiplier
+    )
+    actual = NumPyCompositor().composite(
+        base.copy(), layer, offset, alpha_multiplier
+    )
+    assert max_difference(expected, actual) <= TOLERANCE
+
+
+@pytest.mark.parametrize("alpha_multiplier", [0.95, 0.5, 0.01])
+def test_fade_matches(alpha_multiplier):
+    image = random_image((64, 64), seed=3)
+    expected = PILCompositor().fade(image, alpha_multiplier)
+    actual = NumPyCompositor().fade(image, alpha_multiplier)
+    assert max_difference(expected, actual) <= TOLERANCE
@@ -0,0 +1,114 @@
+"""Check the fade-canvases maintenance command's steps against SQLite."""
+
+from datetime import datetime
+
+from PIL import Image
+import pytest
+
+
+@pytest.fixture
+def session(app):
+    from mira.extensions import db
+    from mira.models import Canvas, Friendship
+
+    with app.app_context():
+        yield db.session
+        db.session.rollback()
+        Friendship.query.delete()
+        Canvas.query.delete()
+        db.session.commit()
+        db.session.remove()
+
+
+def add_canvas(session, alpha, periods_ago, version=3):
+    """Add a canvas filled with the given alpha, last faded a while ago."""
+    from mira.models import CANVAS_SIZE, FADE_PERIOD, Canvas, encode_canvas
+
+    image = Image.new("RGBA", CANVAS_SIZE, (255, 0, 0, alpha))
+    canvas = Canvas(
+        version=version,
+        changes=[[version, 0, 0, 10, 10]],
+        last_fade=datetime.utcnow() - periods_ago * FADE_PERIOD,
+    )
+    canvas.data, canvas.data_format = encode_canvas(image)
+    session.add(canvas)
+    session.commit()
+    return canvas.id
+
+
+def alpha(canvas):
+    from mira.models import decode_canvas
+
+    image = decode_canvas(canvas.data, canvas.data_format)
+    return image.getchannel("A").getextrema()[1]
+
+
+def test_deletes_orphaned_canvases(session):
+    from mira.maintenance import delete_orphaned_canvases
+    from mira.models import Canvas, Friendship
+
+    shared = add_canvas(session, 255, 0)
+    add_canvas(session, 255, 0)
+    # SQLite doesn't enforce foreign keys, so there's no need for users.
+    session.execute(
+        Friendship.__table__.insert().values(
+            friender_id=1, friendee_id=2, canvas_id=shared
+        )
+    )
+    session.commit()
+    assert delete_orphaned_canvases() == 1
+    assert [c.id for c in Canvas.query.all()] == [shared]
+
+
+def test_fades_and_bumps_version(session):
+    from mira.maintenance import fade_canvases
+    from mira.models import CANVAS_BOX, FADE_PERIOD, Canvas
+
+    canvas_id = add_canvas(session, 255, 2.5)
+    last_fade = Canvas.query.get(canvas_id).last_fade
+    session.commit()
+    stats = fade_canvases(batch_size=10, workers=0)
+    assert stats["faded"] == 1
+    canvas = Canvas.query.get(canvas_id)
+    assert canvas.version == 4
+    assert canvas.changes[-1] == [4, *CANVAS_BOX]
+    assert canvas.last_fade == last_fade + 2 * FADE_PERIOD
+    # Two periods at 0.95 each, give or take rounding.
+    assert abs(alpha(canvas) - 255 * 0.95 ** 2) <= 2
+    # Nothing is pending now, so running again changes nothing.
+    session.commit()
+    assert fade_canvases(batch_size=10, workers=0)["canvases"] == 0
+
+
+def test_clears_invisible_canvases(session, app):
+    from mira.maintenance import fade_canvases
+    from mira.models import Canvas
+
+    canvas_id = add_canvas(session, app.config["CANVAS_VISIBLE_ALPHA"], 1)
+    stats = fade_canvases(batch_size=10, workers=0)
+    assert stats["cleared"] == 1
+    canvas = Canvas.query.get(canvas_id)
+    assert canvas.data is None
+    assert canvas.last_fade is None
+    assert canvas.version == 4
+
+
+def test_skips_canvases_changed_meanwhile(session, monkeypatch):
+    import mira.maintenance
+    from mira.models import Canvas
+
+    canvas_id = add_canvas(session, 255, 1)
+    fade_blobs = mira.maintenance.fade_blobs
+
+    def fade_during_sync(*args):
+        # Someone syncs the canvas while it's being faded.
+        Canvas.query.filter_by(id=canvas_id).update({"version": 10})
+        return fade_blobs(*args)
+
+    monkeypatch.setattr(mira.maintenance, "fade_blobs", fade_during_sync)
+    stats = mira.maintenance.fade_canvases(batch_size=10, workers=0)
+    assert stats["skipped"] == 1
+    assert stats["faded"] == 0
+    canvas = Canvas.query.get(canvas_id)
+    assert canvas.version == 10
+    assert alpha(canvas) == 255
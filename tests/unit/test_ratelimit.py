@@ -0,0 +1,75 @@
+"""Check the SQL rate limit storage against SQLite."""
+
+from collections import namedtuple
+
+import pytest
+
+
+Row = namedtuple("Row", "window_start expiry count previous")
+
+
+@pytest.fixture
+def storage(app, tmp_path):
+    from mira.ratelimit import SQLStorage
+
+    return SQLStorage(f"sqlite:///{tmp_path}/limits.sqlite")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1050.0]
+    monkeypatch.setattr("mira.ratelimit.time", lambda: now[0])
+    return now
+
+
+@pytest.mark.parametrize(
+    "row, count",
+    [
+        (None, 0),
+        # The current window counts in full, and the previous one by overlap.
+        (Row(1000, 100, 3, 10), 3 + 7),
+        # The current window is empty, but the previous one still overlaps.
+        (Row(900, 100, 8, 5), 6),
+        (Row(800, 100, 8, 5), 0),
+    ],
+)
+def test_weighted_count(app, row, count):
+    from mira.ratelimit import weighted_count
+
+    assert weighted_count(row, 1025) == count
+
+
+def test_incr_counts_hits(storage, clock):
+    assert storage.incr("key", 100) == 1
+    assert storage.incr("key", 100) == 2
+    assert storage.incr("other", 100) == 1
+    assert storage.get("key") == 2
+    assert storage.get_expiry("key") == 1100
+
+
+def test_incr_slides_into_next_window(storage, clock):
+    storage.incr("key", 100)
+    storage.incr("key", 100)
+    clock[0] = 1125.0
+    # One hit now, plus three quarters of the previous window's two.
+    assert storage.incr("key", 100) == 1 + 1
+    clock[0] = 1250.0
+    assert storage.incr("key", 100) == 1
+
+
+def test_clear_and_reset(storage, clock):
+    storage.incr("key", 100)
+    storage.incr("other", 100)
+    storage.clear("key")
+    assert storage.get("key") == 0
+    assert storage.reset() == 1
+    assert storage.get("other") == 0
+
+
+def test_shares_app_engine(app):
+    from mira.extensions import db
+    from mira.ratelimit import SQLStorage
+
+    storage = SQLStorage(app.config["SQLALCHEMY_DATABASE_URI"])
+    assert storage.get_engine() is db.engine
+    assert storage.incr("key", 100) == 1
@@ -1,6 +1,6 @@
 import axios from "axios";
 
-import { API_REQUEST_TIMEOUT } from "@/constants";
+import { API_REQUEST_TIMEOUT, LONG_POLL_TIME } from "@/constants";
 import { isDevelopment } from "@/util";
 
 export default axios.create({
@@ -14,3 +14,19 @@ export default axios.create({
   responseType: "json",
   timeout: API_REQUEST_TIMEOUT
 });
+
+// Long-polls go to the server's wait listener if it has one (see
+// mira/waits.py). Otherwise the API answers them without waiting.
+export const longPoll = axios.create({
+  baseURL: process.env.VUE_APP_WAIT_BACKEND || process.env.VUE_APP_BACKEND,
+  withCredentials: isDevelopment(),
+  headers: {
+    "X-Requested-With": "XMLHttpRequest"
+  },
+  params: {
+    wait: LONG_POLL_TIME / 1000
+  },
+  responseType: "json",
+  timeout: LONG_POLL_TIME + API_REQUEST_TIMEOUT,
+  validateStatus: status => (status >= 200 && status < 300) || status === 304
+});
@@ -6,8 +6,15 @@ export const APP_SIZE = 500; // px
 
 export const API_REQUEST_TIMEOUT = 5000; // ms
 export const IDLE_SYNC_TIME = 5000; // ms
-export const LOAD_REFRESH_TIME = 60000; // ms
-export const PERIODIC_SYNC_TIME = 30000; // ms
+// How long long-polls ask the server to wait for a change.
+export const LONG_POLL_TIME = 25000; // ms
+// The least time between long-polls.
+export const MIN_POLL_TIME = 1000; // ms
+// How often to poll if the server answers long-polls without waiting.
+export const LOAD_REFRESH_TIME = 120000; // ms
+// Long-polls bring in friends' changes, so this only saves strokes that the
+// idle sync missed.
+export const PERIODIC_SYNC_TIME = 120000; // ms
 
 export const DEFAULT_BRUSH_COLOR = "#000000";
 export const DEFAULT_BRUSH_SIZE = 3; // px
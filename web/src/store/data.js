@@ -1,12 +1,13 @@
 import Vue from "vue";
 import isEqual from "lodash.isequal";
 
-import api from "@/api";
+import api, { longPoll } from "@/api";
 
 function initialState() {
   return {
     data: {},
     errors: {},
+    etags: {},
     refreshKey: 0
   };
 }
@@ -71,8 +72,9 @@ export default {
       Vue.set(state.errors, key, error);
     },
 
-    loadSuccess(state, { key, value }) {
+    loadSuccess(state, { key, value, etag }) {
       Vue.set(state.data, key, value);
+      Vue.set(state.etags, key, etag);
     },
 
     refresh(state) {
@@ -94,12 +96,44 @@ export default {
         commit("loadError", { key, error });
         return;
       }
-      commit("loadSuccess", { key, value: response.data });
+      let etag = response.headers.etag;
+      commit("loadSuccess", { key, value: response.data, etag });
       if (!isEqual(oldData, getters.getData(resource))) {
         commit("refresh");
       }
     },
 
+    // Wait for the resource to change, and return whether it did.
+    async poll({ commit, getters, rootGetters, state }, resource) {
+      if (!rootGetters["auth/isLoggedIn"]) {
+        return false;
+      }
+      let oldData = getters.getData(resource);
+      let key = resourceKey(resource);
+      let etag = state.etags[key];
+      let response;
+      try {
+        response = await longPoll.get(key, {
+          headers: etag ? { "If-None-Match": etag } : {}
+        });
+      } catch (error) {
+        // Only record errors from the server, not timeouts.
+        if (error.response) {
+          commit("loadError", { key, error });
+        }
+        return false;
+      }
+      if (response.status === 304) {
+        return false;
+      }
+      etag = response.headers.etag;
+      commit("loadSuccess", { key, value: response.data, etag });
+      if (!isEqual(oldData, getters.getData(resource))) {
+        commit("refresh");
+      }
+      return true;
+    },
+
     async set({ commit }, { resource, value }) {
       let key = resourceKey(resource);
       commit("loadSuccess", { key, value });
@@ -2,6 +2,10 @@ export function isDevelopment() {
   return process.env.NODE_ENV === "development";
 }
 
+export function sleep(ms) {
+  return new Promise(resolve => setTimeout(resolve, ms));
+}
+
 export function errorStatus(error) {
   return error.response && error.response.status;
 }
@@ -45,3 +49,8 @@ export function makeDataURL(data) {
 export function extractDataURL(dataURL) {
   return dataURL.substr(dataURL.indexOf(",") + 1);
 }
+
+export function backendURL(path) {
+  let base = process.env.VUE_APP_BACKEND;
+  return base ? new URL(path, base).href : path;
+}